@@ -0,0 +1,125 @@
+"""
+Strategies for choosing the target cell of the individualization-refinement
+search.
+
+A strategy is a function (G, cells) -> color, where cells maps every color
+class of G with at least two vertices to its vertices in index order.
+"""
+from graph_adj import *
+from fast_col_ref import color_refinement
+
+
+def cells_of(G: "Graph") -> dict:
+    """
+    Returns the non-singleton color classes of G in order of first
+    appearance, computed in a single pass over the colors
+    """
+    cells = {}
+    for i, c in enumerate(G.colors):
+        if c in cells:
+            cells[c].append(i)
+        else:
+            cells[c] = [i]
+    return {c: vs for c, vs in cells.items() if len(vs) >= 2}
+
+
+def cell_degree(G: "Graph", cells: dict, c: "int") -> int:
+    return len(G.neighbors[cells[c][0]])
+
+
+def largest_cell(G: "Graph", cells: dict) -> int:
+    return max(cells, key=lambda c: len(cells[c]))
+
+
+def size_degree_cell(G: "Graph", cells: dict) -> int:
+    return max(cells, key=lambda c: (len(cells[c]), cell_degree(G, cells, c)))
+
+
+def first_cell(G: "Graph", cells: dict) -> int:
+    return next(iter(cells))
+
+
+def min_degree_cell(G: "Graph", cells: dict) -> int:
+    return min(cells, key=lambda c: cell_degree(G, cells, c))
+
+
+def joined_cell(G: "Graph", cells: dict) -> int:
+    """
+    Selects the largest cell that is non-trivially joined to a cell, i.e.
+    its vertices are adjacent to some but not all vertices of that cell.
+    Since the coloring is stable looking at one vertex per cell suffices.
+    """
+    sizes = {}
+    for c in G.colors:
+        sizes[c] = sizes.get(c, 0) + 1
+
+    best = None
+    for c, vs in cells.items():
+        counts = {}
+        for n in G.neighbors[vs[0]]:
+            d = G.colors[n]
+            counts[d] = counts.get(d, 0) + 1
+        if any(k < sizes[d] for d, k in counts.items()):
+            if best is None or len(vs) > len(cells[best]):
+                best = c
+    if best is None:
+        return largest_cell(G, cells)
+    return best
+
+
+STRATEGIES = {
+    "largest": largest_cell,
+    "size_degree": size_degree_cell,
+    "first": first_cell,
+    "min_degree": min_degree_cell,
+    "joined": joined_cell,
+}
+DEFAULT_STRATEGY = "largest"
+
+# Strategy chosen by auto mode for every family of graphs seen so far
+family_strategy = {}
+
+
+def family_key(G: "Graph"):
+    return G.size, G.num_edges, tuple(sorted(set(G.degrees)))
+
+
+def estimate_tree_size(G: "Graph", select) -> int:
+    """
+    Probes a single path down the search tree of G, individualizing the
+    first vertex of the cell chosen by select at every level, and returns
+    the product of the target cell sizes along it. This is an estimate of
+    the number of leaves the search has to consider.
+    """
+    colors = G.colors
+    G.colors = colors.copy()
+    estimate = 1
+    try:
+        color_refinement(G, reset_colors=False)
+        cells = cells_of(G)
+        while cells:
+            c = select(G, cells)
+            estimate *= len(cells[c])
+            new_color = max(G.colors) + 1
+            G.colors[cells[c][0]] = new_color
+            color_refinement(G, reset_colors=False, splitters=[new_color])
+            cells = cells_of(G)
+    finally:
+        G.colors = colors
+    return estimate
+
+
+def choose_strategy(G: "Graph", strategy: "str" = DEFAULT_STRATEGY) -> str:
+    """
+    Resolves the auto strategy to the strategy with the smallest estimated
+    search tree for the family of G, any other strategy is returned as is
+    """
+    if strategy != "auto":
+        return strategy
+
+    key = family_key(G)
+    if key not in family_strategy:
+        family_strategy[key] = min(
+            STRATEGIES,
+            key=lambda s: estimate_tree_size(G, STRATEGIES[s]))
+    return family_strategy[key]
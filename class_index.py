@@ -0,0 +1,249 @@
+"""
+In-memory classification index and the daemon that serves it over a local
+socket, so that graphs, automorphism counts and classes outlive a single
+run. Requests and replies are dicts sent over multiprocessing.connection:
+
+    {"op": "add", "graph": g, "name": s}  -> {"id", "class", "new_class"}
+    {"op": "find", "graph": g}            -> {"class", "members", "mapping",
+                                              "undecided"}
+    {"op": "aut", "id": i}, "class": c
+                      or "graph": g       -> {"automorphisms"}
+    {"op": "load", "path": p, "jobs": j}  -> {"added": [{"id", "class"}]}
+    {"op": "stop"}                        -> {}
+
+where g is a graph as packed by shard.pack and mapping an isomorphism of
+the first member of the class onto g, see graph_lib.is_isomorphism. A find
+whose tests ran out of budget before a class was found answers no class
+and undecided true. Failed requests are answered with {"error": message}.
+"""
+from collections import Counter
+from multiprocessing.connection import Listener, Client
+from graph_io_adj import load_graph_file
+from fast_col_ref import color_refinement
+from classify import Classifier
+from graph_lib import UNDECIDED, BudgetExceeded
+from shard import pack, unpack
+
+
+class ClassIndex:
+    """
+    Graphs with their isomorphism classes and automorphism counts. Unlabeled
+    trees are looked up by their certificate, other graphs are only tested
+    against the representatives of the classes with the same invariants.
+    """
+
+    def __init__(self, classifier: "Classifier" = None):
+        self.classifier = Classifier() if classifier is None else classifier
+        # Graph id -> graph, name and class id
+        self.graphs = list()
+        self.names = list()
+        self.class_of = list()
+        # Class id -> graph ids, the first one is the representative
+        self.classes = list()
+        # Invariant -> class ids
+        self.buckets = dict()
+        # Class id -> automorphism count
+        self.counts = dict()
+
+    def invariant(self, G: "Graph"):
+        """
+        Returns a key that is equal for isomorphic graphs: the certificate
+        of an unlabeled tree, else the size, number of edges, degrees and
+        sizes of the stable color classes, which start from the labels
+        """
+        if G.is_tree() and not G.is_labeled:
+            return "T", self.classifier.codes.certificate(G)
+        colors = G.colors
+        G.colors = colors.copy()
+        try:
+            color_refinement(G)
+            cells = tuple(sorted(Counter(G.colors).values()))
+        finally:
+            G.colors = colors
+        return "G", G.size, G.num_edges, tuple(sorted(G.degrees)), cells
+
+    def find(self,
+             G: "Graph",
+             key=None,
+             mapping: "List" = None,
+             classifier: "Classifier" = None):
+        """
+        Returns the id of the class of G, or None if it has none yet, and
+        appends an isomorphism of the first member of the class onto G to
+        mapping. Raises BudgetExceeded if no class was found but a test ran
+        out of budget. classifier runs the tests instead of the index's own.
+        """
+        if classifier is None:
+            classifier = self.classifier
+        if key is None:
+            key = self.invariant(G)
+        undecided = False
+        for c in self.buckets.get(key, ()):
+            rep = self.graphs[self.classes[c][0]]
+            # Tree certificates are exact
+            if key[0] == "T":
+                if mapping is not None:
+                    mapping.extend(classifier.codes.isomorphism(rep, G))
+                return c
+            iso = classifier.is_iso(rep, G, mapping)[0]
+            if iso is UNDECIDED:
+                undecided = True
+            elif iso:
+                return c
+        if undecided:
+            raise BudgetExceeded()
+        return None
+
+    def add(self, G: "Graph", name: "str" = None):
+        """
+        Indexes G, returns its id, the id of its class and whether the class
+        is new. A graph is only given a new class once it is known to be
+        non isomorphic to all others, tests that run out of budget are
+        repeated without limits.
+        """
+        key = self.invariant(G)
+        try:
+            c = self.find(G, key)
+        except BudgetExceeded:
+            c = self.find(G, key, classifier=self.classifier.unlimited())
+        new_class = c is None
+        if new_class:
+            c = len(self.classes)
+            self.classes.append(list())
+            self.buckets.setdefault(key, list()).append(c)
+
+        i = len(self.graphs)
+        self.graphs.append(G)
+        self.names.append(name)
+        self.class_of.append(c)
+        self.classes[c].append(i)
+        return i, c, new_class
+
+    def aut_count(self, i: "int"):
+        """
+        Returns the automorphism count of graph i, computed once per class
+        """
+        return self.class_aut_count(self.class_of[i])
+
+    def class_aut_count(self, c: "int"):
+        if self.counts.get(c) is None:
+            rep = self.classes[c][0]
+            self.counts[c] = self.classifier.automorphs(self.graphs,
+                                                        [rep]).counts[rep]
+        return self.counts[c]
+
+    def members(self, c: "int"):
+        return [self.names[i] or i for i in self.classes[c]]
+
+    def handle(self, request: "dict") -> dict:
+        op = request.get("op")
+        if op == "add":
+            i, c, new_class = self.add(unpack(*request["graph"]),
+                                       request.get("name"))
+            return {"id": i, "class": c, "new_class": new_class}
+        elif op == "find":
+            mapping = list()
+            undecided = False
+            try:
+                c = self.find(unpack(*request["graph"]), mapping=mapping)
+            except BudgetExceeded:
+                c = None
+                undecided = True
+            return {
+                "class": c,
+                "members": [] if c is None else self.members(c),
+                "mapping": mapping if c is not None else None,
+                "undecided": undecided
+            }
+        elif op == "aut":
+            if "graph" in request:
+                G = unpack(*request["graph"])
+                try:
+                    c = self.find(G)
+                except BudgetExceeded:
+                    c = None
+                if c is None:
+                    return {
+                        "automorphisms":
+                        self.classifier.automorphs([G], [0]).counts[0]
+                    }
+            elif "class" in request:
+                c = request["class"]
+            else:
+                c = self.class_of[request["id"]]
+            return {"automorphisms": self.class_aut_count(c)}
+        elif op == "load":
+            path = request["path"]
+            graphs = load_graph_file(path, request.get("jobs"))
+            added = list()
+            for k, G in enumerate(graphs):
+                i, c, _ = self.add(G, "{}:{}".format(path, k))
+                added.append({"id": i, "class": c})
+            return {"added": added}
+        elif op == "stop":
+            return {}
+        raise ValueError("Unknown request {}".format(op))
+
+
+def serve_index(address,
+                index: "ClassIndex",
+                authkey: "bytes",
+                verbose: "bool" = False):
+    """
+    Answers the requests of one client connection after the other until a
+    client sends stop
+    """
+    with Listener(address, authkey=authkey) as listener:
+        while True:
+            with listener.accept() as conn:
+                while True:
+                    try:
+                        request = conn.recv()
+                    except (EOFError, OSError):
+                        break
+                    if verbose:
+                        print("Request", request.get("op"))
+                    try:
+                        conn.send(index.handle(request))
+                    except Exception as e:
+                        conn.send({"error": str(e)})
+                    if request.get("op") == "stop":
+                        return
+
+
+class IndexClient:
+    """
+    Connection to a running index daemon
+    """
+
+    def __init__(self, address, authkey: "bytes"):
+        self.conn = Client(address, authkey=authkey)
+
+    def request(self, **request) -> dict:
+        self.conn.send(request)
+        return self.conn.recv()
+
+    def add(self, G: "Graph", name: "str" = None) -> dict:
+        return self.request(op="add", graph=pack(G), name=name)
+
+    def find(self, G: "Graph") -> dict:
+        return self.request(op="find", graph=pack(G))
+
+    def aut_count(self,
+                  G: "Graph" = None,
+                  i: "int" = None,
+                  c: "int" = None) -> dict:
+        if G is not None:
+            return self.request(op="aut", graph=pack(G))
+        if c is not None:
+            return self.request(op="aut", **{"class": c})
+        return self.request(op="aut", id=i)
+
+    def load(self, path: "str") -> dict:
+        return self.request(op="load", path=path)
+
+    def stop(self):
+        return self.request(op="stop")
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,370 @@
+"""
+Library entry point: isomorphism classes and automorphism counts of already
+loaded graphs, computed once per call with shared intermediate results.
+
+    from classify import classify
+    result = classify(graphs, strategy="aut_first", timeout=10)
+    for c in result.classes:
+        print(c, result.counts[c[0]])
+"""
+import sys
+from copy import copy
+from is_iso import is_iso
+from count_aut import count_aut
+from graph_lib import Budget, UNDECIDED, SubtreeCodes, is_isomorphism
+from cell_selection import DEFAULT_STRATEGY
+from fast_col_ref import batch_refinement
+
+# iso_first: classes first, automorphisms of one graph per class
+# aut_first: automorphisms of every graph first, then classes among the
+#            graphs with an equal number
+CLASSIFY_STRATEGIES = ("iso_first", "aut_first")
+
+
+class Classification:
+    def __init__(self):
+        # Sorted lists of graph indices
+        self.classes = list()
+        # Graph index -> number of automorphisms, or UNDECIDED
+        self.counts = dict()
+        # Graph index -> generating set of its automorphism group
+        self.generators = dict()
+        # Graph index -> isomorphism of the first graph of its class onto
+        # it, for all but the first graph of every class
+        self.mappings = dict()
+        # Pairs of graph indices in different classes whose test ran out
+        # of budget
+        self.undecided = list()
+
+
+class IsoClasses:
+    """
+    Union-find over graph keys with class level negative results: once two
+    classes are known to be non isomorphic, no members of them are
+    compared again, also after either class grows.
+    """
+
+    def __init__(self, keys):
+        self.parent = {k: k for k in keys}
+        self.size = {k: 1 for k in self.parent}
+        # Root -> roots of the classes known to be non isomorphic with it
+        self.non_iso = {k: set() for k in self.parent}
+
+    def find(self, k):
+        while self.parent[k] != k:
+            self.parent[k] = self.parent[self.parent[k]]
+            k = self.parent[k]
+        return k
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return a
+        if self.size[a] < self.size[b]:
+            a, b = b, a
+        self.parent[b] = a
+        self.size[a] += self.size[b]
+        for c in self.non_iso.pop(b):
+            self.non_iso[c].discard(b)
+            self.non_iso[c].add(a)
+            self.non_iso[a].add(c)
+        return a
+
+    def separate(self, a, b):
+        a, b = self.find(a), self.find(b)
+        self.non_iso[a].add(b)
+        self.non_iso[b].add(a)
+
+    def is_separated(self, a, b) -> bool:
+        return self.find(b) in self.non_iso[self.find(a)]
+
+    def classes(self):
+        """
+        Returns the classes as sorted lists, those with several members
+        first, each group ordered by smallest member
+        """
+        members = dict()
+        for k in sorted(self.parent):
+            members.setdefault(self.find(k), list()).append(k)
+        return [c for c in members.values() if len(c) > 1
+                ] + [c for c in members.values() if len(c) == 1]
+
+
+class Classifier:
+    """
+    Options and state shared by all tests and counts: the result cache, the
+    subtree codes of the trees seen so far and the search settings.
+    """
+
+    def __init__(self,
+                 timeout: "float" = None,
+                 max_nodes: "int" = None,
+                 cell: "str" = DEFAULT_STRATEGY,
+                 wl2: "int" = 0,
+                 batch: "bool" = False,
+                 cache: "ResultCache" = None,
+                 codes: "SubtreeCodes" = None,
+                 verbose: "bool" = False,
+                 parallel: "int" = None,
+                 parallel_depth: "int" = 1):
+        self.timeout = timeout
+        self.max_nodes = max_nodes
+        self.cell = cell
+        self.wl2 = wl2
+        self.batch = batch
+        self.cache = cache
+        self.codes = SubtreeCodes() if codes is None else codes
+        self.verbose = verbose
+        self.parallel = parallel
+        self.parallel_depth = parallel_depth
+
+    def unlimited(self) -> "Classifier":
+        """
+        Returns a copy of this classifier whose tests and counts run without
+        time or node limits
+        """
+        classifier = copy(self)
+        classifier.timeout = None
+        classifier.max_nodes = None
+        return classifier
+
+    def budget(self):
+        """
+        Budget of a single test or count, without limits it only counts
+        the search nodes
+        """
+        return Budget(self.timeout, self.max_nodes)
+
+    def is_iso(self, a: "Graph", b: "Graph", mapping: "List" = None):
+        """
+        Isomorphism test through the cache, returns the result and the
+        budget it used, which is None for a cached result. An isomorphism
+        of a to b is appended to mapping. Cached positive results are only
+        taken if their stored isomorphism checks out.
+        """
+        budget = None
+        found = list()
+        result = self.cache.iso(a, b) if self.cache else None
+        if result:
+            stored = self.cache.mapping(a, b)
+            if stored is not None and is_isomorphism(a, b, stored):
+                found = stored
+            else:
+                result = None
+        if result is None:
+            budget = self.budget()
+            result = is_iso(a, b, budget, self.cell, self.codes, self.wl2,
+                            self.parallel, self.parallel_depth, found)
+            if self.cache and result is not UNDECIDED:
+                self.cache.store_iso(a, b, result, found if result else None)
+        if result and mapping is not None:
+            mapping.extend(found)
+        return result, budget
+
+    def warm_is_iso(self, a: "Graph", b: "Graph", colors_a: "List",
+                    colors_b: "List", mapping: "List" = None):
+        """
+        is_iso starting from the given stable colorings of a and b, whose
+        own colors are given back afterwards
+        """
+        old = a.colors, b.colors
+        a.colors, b.colors = list(colors_a), list(colors_b)
+        try:
+            return self.is_iso(a, b, mapping)
+        finally:
+            a.colors, b.colors = old
+
+    def cached_generators(self, g: "Graph"):
+        """
+        Returns the generating set of Aut(g) stored in the cache if all of
+        them are automorphisms of g, else None. Unlabeled trees are counted
+        without generators.
+        """
+        if g.is_tree() and not g.is_labeled:
+            return list()
+        generators = self.cache.generators(g)
+        if generators is None or not all(
+                is_isomorphism(g, g, P.P) for P in generators):
+            return None
+        return generators
+
+    def automorphs(self,
+                   graphs: "List[Graph]",
+                   indices: "List[int]",
+                   result: "Classification" = None) -> Classification:
+        """
+        Counts the automorphisms of graphs[i] for every i in indices
+        """
+        if result is None:
+            result = Classification()
+
+        for i in indices:
+            g = graphs[i]
+            if self.verbose:
+                print("Calculating automorph for graph [{}]".format(i),
+                      file=sys.stderr)
+            count = self.cache.aut_count(g) if self.cache else None
+            generators = None
+            if count is not None:
+                generators = self.cached_generators(g)
+            if generators is not None:
+                if self.verbose:
+                    print("Found automorphs for graph [{}] in the cache".
+                          format(i), file=sys.stderr)
+                result.counts[i] = count
+                result.generators[i] = generators
+                continue
+
+            budget = self.budget()
+            generators = list()
+            result.counts[i] = count_aut(g, budget, self.cell, generators,
+                                         self.codes, self.wl2, self.parallel)
+            result.generators[i] = generators
+            if self.cache and result.counts[i] is not UNDECIDED:
+                self.cache.store_aut(g, result.counts[i], generators)
+            if self.verbose and result.counts[i] is UNDECIDED:
+                print("Undecided automorphs for graph [{}] after {} nodes".
+                      format(i, budget.nodes), file=sys.stderr)
+
+        return result
+
+    def equivalence_classes(self,
+                            graphs: "List[Graph]",
+                            indices: "List[int]",
+                            result: "Classification" = None,
+                            counts: "dict" = None) -> Classification:
+        """
+        Adds the isomorphism classes of graphs[i], i in indices, and the
+        isomorphisms of their first graphs onto the others to result. Every
+        graph is tested against the representative of each class found so
+        far, unless they have a different number of automorphisms in counts
+        or, with batch, different color histograms. Pairs whose test ran out of budget are added to
+        result.undecided when they did not end up in the same class.
+        """
+        if result is None:
+            result = Classification()
+        zipper = sorted(indices)
+
+        if self.verbose:
+            print("Calculating equivalence classes for graphs",
+                  zipper,
+                  file=sys.stderr)
+
+        # The stable colorings are the warm start of every test
+        if self.batch:
+            histograms, colorings = batch_refinement(
+                [graphs[i] for i in zipper])
+            histograms = dict(zip(zipper, histograms))
+            colorings = dict(zip(zipper, colorings))
+
+        classes = IsoClasses(zipper)
+        undecided_pairs = list()
+        reps = list()
+        for j in zipper:
+            for r in reps:
+                if self.verbose:
+                    print("Checking for isomorphism between {} and {}".format(
+                        r, j), file=sys.stderr)
+                if counts is not None and UNDECIDED not in (
+                        counts[r], counts[j]) and counts[r] != counts[j]:
+                    if self.verbose:
+                        print("{} and {} have different numbers of automorphs".
+                              format(r, j), file=sys.stderr)
+                    classes.separate(r, j)
+                    continue
+                if self.batch and histograms[r] != histograms[j]:
+                    if self.verbose:
+                        print("{} and {} have different color histograms".
+                              format(r, j), file=sys.stderr)
+                    classes.separate(r, j)
+                    continue
+
+                mapping = list()
+                if self.batch:
+                    iso, budget = self.warm_is_iso(graphs[r], graphs[j],
+                                                   colorings[r], colorings[j],
+                                                   mapping)
+                else:
+                    iso, budget = self.is_iso(graphs[r], graphs[j], mapping)
+                if budget is None and self.verbose:
+                    print("Found result for {} and {} in the cache".format(
+                        r, j), file=sys.stderr)
+
+                if iso is UNDECIDED:
+                    if self.verbose:
+                        print(
+                            "Undecided whether {} and {} are isomorphic after {} nodes"
+                            .format(r, j, budget.nodes),
+                            file=sys.stderr)
+                    undecided_pairs.append([r, j])
+                elif iso:
+                    if self.verbose:
+                        print("{} and {} are isomorphic".format(r, j),
+                              file=sys.stderr)
+                    classes.union(r, j)
+                    result.mappings[j] = mapping
+                    break
+                else:
+                    classes.separate(r, j)
+            else:
+                reps.append(j)
+
+        result.classes.extend(classes.classes())
+        for i, j in undecided_pairs:
+            if classes.find(i) != classes.find(j):
+                result.undecided.append([i, j])
+        return result
+
+    def classify(self,
+                 graphs: "List[Graph]",
+                 strategy: "str" = "iso_first",
+                 indices: "List[int]" = None,
+                 iso: "bool" = True,
+                 aut: "bool" = True) -> Classification:
+        if strategy not in CLASSIFY_STRATEGIES:
+            raise ValueError("Unknown strategy {}".format(strategy))
+        if indices is None:
+            indices = range(len(graphs))
+        indices = sorted(indices)
+
+        result = Classification()
+        if not aut:
+            return self.equivalence_classes(graphs, indices, result)
+        if not iso:
+            return self.automorphs(graphs, indices, result)
+
+        if strategy == "iso_first":
+            self.equivalence_classes(graphs, indices, result)
+            self.automorphs(graphs, [c[0] for c in result.classes], result)
+            # Isomorphic graphs share the count of their class
+            for c in result.classes:
+                for i in c:
+                    result.counts[i] = result.counts[c[0]]
+        else:
+            # Only graphs with equal numbers of automorphs are compared,
+            # graphs whose number is undecided with all others
+            self.automorphs(graphs, indices, result)
+            counts = dict(result.counts)
+            self.equivalence_classes(graphs, indices, result, counts)
+            for c in result.classes:
+                known = [counts[i] for i in c if counts[i] is not UNDECIDED]
+                if known:
+                    for i in c:
+                        result.counts[i] = known[0]
+        return result
+
+
+def classify(graphs: "List[Graph]",
+             strategy: "str" = "iso_first",
+             indices: "List[int]" = None,
+             iso: "bool" = True,
+             aut: "bool" = True,
+             **options) -> Classification:
+    """
+    Returns the isomorphism classes (if iso) and automorphism counts (if
+    aut) of graphs[i] for every i in indices, all graphs by default.
+    strategy is one of CLASSIFY_STRATEGIES, options are the keyword
+    arguments of Classifier.
+    """
+    return Classifier(**options).classify(graphs, strategy, indices, iso,
+                                          aut)
@@ -1,133 +1,321 @@
 from sys import argv
-from math import factorial
-import itertools as it
 from permv2 import *
-from collections import deque, Counter
+from collections import deque
 from graph_adj import *
-from fast_col_ref import color_refinement
-from graph_lib import is_unbalanced, is_bijective, cycles_from_mapping, membership_test, cardinality_generating_set
-from is_iso import tree_isomorphism
+from fast_col_ref import color_refinement, pair_refinement
+from graph_lib import is_unbalanced, is_bijective, leaf_mapping, is_isomorphism, membership_test, cardinality_generating_set, Budget, BudgetExceeded, UNDECIDED, SubtreeCodes
+from cell_selection import STRATEGIES, DEFAULT_STRATEGY, cells_of, choose_strategy
+from basicpermutationgroup import Orbit
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import Event
+
+
+def individualize_pair(colors: "List", v: "int", candidates: "List",
+                      offset: "int", new_color: "int", is_trivial: "bool"):
+    """
+    Search frame for a single node of the automorphism search: yields the
+    coloring, refinement splitters and triviality of every child node
+    """
+    for u in candidates:
+        child = colors.copy()
+        child[v] = new_color
+        child[u + offset] = new_color
+        yield child, [new_color], v == u and is_trivial
+
+
+def refine_node(U: "DisjointUnion", colors: "List", splitters: "List",
+                wl2: "bool"):
+    """
+    Refines U starting from the coloring of a search node, near the root
+    (wl2) with 2-WL as well if color refinement does not split any cell.
+    Returns whether both sides of U end up with the same color histogram.
+    """
+    U.colors = colors
+    if wl2:
+        cells = len(set(colors))
+    if not color_refinement(
+            U, reset_colors=False, splitters=splitters, sides=U.size):
+        return False
+    if wl2 and len(set(U.colors)) == cells:
+        pair_refinement(U)
+        return not is_unbalanced(*U.split_disjoint())
+    return True
 
 
 def count_aut_rec(A: "Graph",
                   B: "Graph",
                   gen_set: "List",
-                  mapping: "List" = list(),
-                  is_trivial: "bool" = True):
+                  is_trivial: "bool" = True,
+                  budget: "Budget" = None,
+                  strategy: "str" = DEFAULT_STRATEGY,
+                  wl2_depth: "int" = 0,
+                  root: "tuple" = None,
+                  root_depth: "int" = 0):
+    """
+    Searches the union of A and B from root, a (colors, splitters,
+    is_trivial) node at depth root_depth, by default the coloring of the
+    union itself, and adds the automorphisms found to gen_set
+    """
+    select = STRATEGIES[choose_strategy(A, strategy)]
+    X, Y = A, B
     U = A + B
-    color_refinement(U, reset_colors=False)
     A, B = U.split_disjoint()
+    # Explicit stack of (search frame, is_trivial) pairs instead of recursion
+    stack = [(iter([root or (U.colors, None, is_trivial)]), False)]
+    while stack:
+        node = next(stack[-1][0], None)
+        if node is None:
+            stack.pop()
+            continue
+        if budget:
+            budget.spend()
 
-    # Check if tree is unbalanced or bijective
-    if is_unbalanced(A, B):
-        return False
-    elif is_bijective(A, B):
-        if is_trivial:
-            # if root.is_trivial():
-            return False
-        else:
-            # Find the mappings induced by color refinement
-            for v in A.vertices:
-                u = next((x for x in B.vertices if x.color == v.color))
-                if (u.i, v.i) not in mapping and (v.i, u.i) not in mapping:
-                    mapping.append((v.i, u.i))
+        colors, splitters, is_trivial = node
+        # Check if tree is unbalanced or bijective
+        if not refine_node(U, colors, splitters,
+                           root_depth + len(stack) <= wl2_depth):
+            continue
+        elif is_bijective(A, B):
+            if is_trivial:
+                # if root.is_trivial():
+                continue
 
-            # Generate cycles and permutation from current mapping
-            cycles = cycles_from_mapping(mapping)
-            perm = permutation(A.size, cycles)
+            mapping = leaf_mapping(U)
+            if not is_isomorphism(X, Y, mapping):
+                continue
+            perm = permutation(A.size, mapping=mapping)
 
             # Test if the permutation is already a member
             if len(gen_set) == 0 or not membership_test(gen_set, perm):
                 gen_set.append(perm)
-                # Return True which means return to the latest trivial node
+            # Return to the latest trivial node instead of continuing, also
+            # if the automorph found is already in the set
+            while stack and not stack[-1][1]:
+                stack.pop()
+            if not stack:
                 return True
-            # If true, return
-            # If automorph found that is already in the set still return to
-            # trivial node instead of continuing
-            # Otherwise use false
-            return True
+            continue
 
-    c_classes = [
-        c for c, n in Counter([v.color for v in A.vertices]).items() if n >= 2
-    ]
+        ref_c_class = select(A, cells_of(A))
 
-    ref_c_class = max(
-        c_classes, key=lambda c: len([v for v in A.vertices if v.color == c]))
+        v = A.colors.index(ref_c_class)
 
-    col_verts = [v for v in A.vertices if v.color == ref_c_class]
+        candidates = [k for k, c in enumerate(B.colors) if c == ref_c_class]
+        stack.append((individualize_pair(U.colors, v, candidates, U.size,
+                                         A.max_color + 1, is_trivial),
+                      is_trivial))
 
-    v = col_verts[0]
+    return False
 
-    v.change_color(A.max_color + 1)
 
-    for u in [k for k in B.vertices if k.color == ref_c_class]:
-        old_u_color = u.color
-        u.change_color(v.color)
+def count_automorphs(graph: "Graph",
+                     budget: "Budget" = None,
+                     strategy: "str" = DEFAULT_STRATEGY,
+                     generators: "List" = None,
+                     wl2_depth: "int" = 0):
+    gen_set = list()
+    # The stable coloring is only needed for the search, the colors of the
+    # graph are given back untouched
+    colors = graph.colors
+    graph.colors = colors.copy()
+    try:
+        color_refinement(graph)
+        count_aut_rec(graph,
+                      graph,
+                      gen_set,
+                      budget=budget,
+                      strategy=strategy,
+                      wl2_depth=wl2_depth)
+    finally:
+        graph.colors = colors
+    if generators is not None:
+        generators.extend(gen_set)
+    return cardinality_generating_set(gen_set)
 
-        new_mapping = mapping.copy()
-        new_mapping.append((v.i, u.i))
-        trivial = False
-        if v.i == u.i and is_trivial:
-            trivial = True
-        if count_aut_rec(A, B, gen_set, new_mapping,
-                         trivial) and not is_trivial:
-            return True
 
-        u.change_color(old_u_color)
+# Graph and cancel event of the parallel search, set in every worker
+_aut_search = None
 
-    return False
+
+def init_aut_worker(G: "Graph", cancel: "Event"):
+    global _aut_search
+    _aut_search = (G, cancel)
 
 
-def count_automorphs(graph: "Graph"):
+def find_automorphism(root: "tuple", depth: "int", timeout: "float",
+                      max_nodes: "int", strategy: "str", wl2_depth: "int"):
+    """
+    Worker task: searches the non-trivial branch below root for a single
+    automorphism. Returns whether one was found, or UNDECIDED, its mapping
+    and the number of nodes visited.
+    """
+    G, cancel = _aut_search
+    budget = Budget(timeout, max_nodes, cancel)
     gen_set = list()
-    color_refinement(graph)
-    count_aut_rec(graph, graph, gen_set)
-    return cardinality_generating_set(gen_set)
+    try:
+        found = count_aut_rec(G,
+                              G,
+                              gen_set,
+                              budget=budget,
+                              strategy=strategy,
+                              wl2_depth=wl2_depth,
+                              root=root,
+                              root_depth=depth)
+    except BudgetExceeded:
+        return UNDECIDED, None, budget.nodes
+    return found, gen_set[0].P if gen_set else None, budget.nodes
 
 
-def tree_count_aut(G: "Graph", root: "Vertex"):
-    if G.size == 1 or G.size == 2:
-        return 1
+def trivial_path(G: "Graph",
+                 budget: "Budget" = None,
+                 strategy: "str" = DEFAULT_STRATEGY,
+                 wl2_depth: "int" = 0) -> List[tuple]:
+    """
+    Follows the search tree of G along its identity individualizations and
+    returns its non-trivial branches as (depth, v, u, path, root) tuples:
+    root is the node mapping v to u after fixing the vertices in path
+    """
+    select = STRATEGIES[choose_strategy(G, strategy)]
+    U = G + G
+    A, B = U.split_disjoint()
+    branches = list()
+    path = list()
+    node = (U.colors, None)
+    while True:
+        if budget:
+            budget.spend()
+        refine_node(U, *node, len(path) < wl2_depth)
+        if is_bijective(A, B):
+            return branches
 
-    _, _, lvl = G.graph_search(root)
+        ref_c_class = select(A, cells_of(A))
+        v = A.colors.index(ref_c_class)
+        candidates = [k for k, c in enumerate(B.colors) if c == ref_c_class]
+        new_color = A.max_color + 1
+        for u in candidates:
+            child = U.colors.copy()
+            child[v] = new_color
+            child[u + U.size] = new_color
+            if u == v:
+                node = (child, [new_color])
+            else:
+                branches.append((len(path) + 1, v, u, list(path),
+                                 (child, [new_color], False)))
+        path.append(v)
 
-    # Get subroots
-    subroots = [r for r in G.vertices if lvl[r.i] == lvl[root.i] + 1]
-    # Get subtrees
-    subtrees = [G.induced_subtree(r, root) for r in subroots]
-    classes = {s: 1 for s in subtrees}
 
-    passed = set()
-    for tree1, tree2 in it.product(subtrees, subtrees):
-        if tree1 == tree2 or tree1 in passed or tree2 in passed:
-            continue
+def parallel_count_automorphs(graph: "Graph",
+                              jobs: "int",
+                              budget: "Budget" = None,
+                              strategy: "str" = DEFAULT_STRATEGY,
+                              generators: "List" = None,
+                              wl2_depth: "int" = 0):
+    """
+    count_automorphs with the non-trivial branches searched by jobs
+    processes, deepest first. The automorphisms they find are merged into
+    one generating set, and a branch mapping v to u is skipped once u is in
+    the orbit of v under the generators found so far that fix its path.
+    Each branch may use the rest of the budget, its nodes are added to
+    budget.
+    """
+    colors = graph.colors
+    graph.colors = colors.copy()
+    try:
+        color_refinement(graph)
+        strategy = choose_strategy(graph, strategy)
+        branches = trivial_path(graph, budget, strategy, wl2_depth)
+        branches.sort(key=lambda b: -b[0])
+        timeout, max_nodes = budget.remaining() if budget else (None, None)
 
-        if tree_isomorphism(tree1, [tree1.vertices[0]], tree2,
-                            [tree2.vertices[0]]):
-            if classes[tree1] != 1:
-                passed.add(tree2)
-                classes[tree1] += 1
-            elif classes[tree2] != 1:
-                passed.add(tree1)
-                classes[tree2] += 1
-            else:
-                passed.add(tree2)
-                classes[tree1] += 1
+        gen_set = list()
+        cancel = Event()
+        with ProcessPoolExecutor(jobs,
+                                 initializer=init_aut_worker,
+                                 initargs=(graph, cancel)) as pool:
+            pending = deque(branches)
+            running = set()
+            undecided = False
+            while (pending or running) and not undecided:
+                while pending and len(running) < jobs:
+                    depth, v, u, path, root = pending.popleft()
+                    fixing = [
+                        g for g in gen_set if all(g.P[x] == x for x in path)
+                    ]
+                    if fixing and u in Orbit(fixing, v):
+                        continue
+                    running.add(
+                        pool.submit(find_automorphism, root, depth, timeout,
+                                    max_nodes, strategy, wl2_depth))
+                if not running:
+                    break
 
-    prod = 1
-    for stree, v in classes.items():
-        if stree in passed:
-            continue
-        rec_tree_count = tree_count_aut(stree, stree.vertices[0])
-        prod *= factorial(v) * pow(rec_tree_count, v)
-    return prod
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    found, mapping, nodes = future.result()
+                    if budget:
+                        budget.nodes += nodes
+                    if found is UNDECIDED:
+                        undecided = True
+                    elif found:
+                        perm = permutation(graph.size, mapping=mapping)
+                        if not gen_set or not membership_test(gen_set, perm):
+                            gen_set.append(perm)
+            if undecided:
+                cancel.set()
+                for future in running:
+                    future.cancel()
+    finally:
+        graph.colors = colors
+    if undecided:
+        raise BudgetExceeded()
+    if generators is not None:
+        generators.extend(gen_set)
+    return cardinality_generating_set(gen_set)
 
 
-def count_aut(G: "Graph") -> int:
-    if G.is_tree():
-        return tree_count_aut(G, G.find_center()[0])
-    else:
-        return count_automorphs(G)
+def tree_count_aut(G: "Graph",
+                   root: "Vertex",
+                   budget: "Budget" = None,
+                   codes: "SubtreeCodes" = None):
+    """
+    Returns the number of automorphisms of the tree G that fix root
+    """
+    if codes is None:
+        codes = SubtreeCodes()
+    return codes.aut[codes.rooted(G, root, budget)]
+
+
+def count_aut(G: "Graph",
+              budget: "Budget" = None,
+              strategy: "str" = DEFAULT_STRATEGY,
+              generators: "List" = None,
+              codes: "SubtreeCodes" = None,
+              wl2_depth: "int" = 0,
+              parallel: "int" = None) -> int:
+    """
+    Returns the number of automorphisms of G, or UNDECIDED if the budget
+    ran out before the search finished. strategy names the target cell
+    selection of the search, see cell_selection.STRATEGIES, or is "auto".
+    The generating set found for non-trees is appended to generators.
+    Unlabeled trees are counted through codes, which can be shared between
+    calls.
+    Dense graphs are searched on their complement.
+    Search nodes up to depth wl2_depth - 1 where color refinement makes no
+    progress are refined with 2-WL as well.
+    """
+    try:
+        if G.is_tree() and not G.is_labeled:
+            if codes is None:
+                codes = SubtreeCodes()
+            return codes.count_aut(G, budget)
+        elif parallel and parallel > 1:
+            return parallel_count_automorphs(sparser(G), parallel, budget,
+                                             strategy, generators, wl2_depth)
+        else:
+            return count_automorphs(sparser(G), budget, strategy,
+                                    generators, wl2_depth)
+    except BudgetExceeded:
+        return UNDECIDED
 
 
 if __name__ == "__main__":
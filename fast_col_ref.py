@@ -1,84 +1,249 @@
 from graph_adj import *
-from collections import deque
-
-
-def color_refinement(G: "Graph", reset_colors=True):
-    # Assign colormap: Color -> [Vertices]
-    color_classes = {}
-    for v in G.vertices:
-        if reset_colors:
-            key = v.degree
+from collections import deque, Counter
+from itertools import chain
+from weakref import WeakKeyDictionary
+
+# Largest number of vertices of a graph pair_refinement is used on, it
+# keeps n^2 pair colors and does O(n^3 log n) work per round
+WL2_MAX_VERTICES = 160
+
+# Starting partitions per graph whose 2-WL colors are kept
+WL2_CACHE_SIZE = 64
+# Graph -> starting partition -> 2-WL colors of its vertices
+_pair_colors = WeakKeyDictionary()
+
+# Splitter cells with more than this many edges per vertex of the graph
+# are counted with adjacency bitsets
+DENSE_SPLITTER = 2
+
+# A popcount over this many bits of a row costs about as much as walking one
+# more neighbor list entry, so large graphs need denser splitters
+DENSE_ROW_BITS = 1024
+
+
+def neighbor_counts(G: "Graph", splitter: "List[int]") -> dict:
+    """
+    Returns the number of neighbors in splitter of every vertex of G that
+    has any, for weighted graphs the sorted ids of the weights of the edges
+    to them. Splitters whose edges outnumber the vertices of G by
+    DENSE_SPLITTER, plus one per DENSE_ROW_BITS vertices, are counted with
+    one popcount of adjacency row & cell mask per vertex instead of walking
+    their neighbor lists.
+    """
+    if G.is_weighted:
+        weights = {}
+        for u in splitter:
+            for w in G.neighbors[u]:
+                weights.setdefault(w, []).append(label_id(G.weight(u, w)))
+        return {w: tuple(sorted(k)) for w, k in weights.items()}
+
+    n = G.abs_size
+    degrees = G.degrees
+    if sum(degrees[u]
+           for u in splitter) > n * (DENSE_SPLITTER + n // DENSE_ROW_BITS):
+        mask = bitmask(splitter, n)
+        counts = {}
+        for v, row in enumerate(G.adj_rows):
+            k = (row & mask).bit_count()
+            if k:
+                counts[v] = k
+        return counts
+
+    counts = {}
+    neighbors = G.neighbors
+    for u in splitter:
+        for w in neighbors[u]:
+            counts[w] = counts.get(w, 0) + 1
+    return counts
+
+
+def initial_colors(G: "Graph") -> List[int]:
+    """
+    Returns the degrees of G, refined by the vertex labels if it has any
+    """
+    if G.labels is None:
+        return list(G.degrees)
+    return with_labels(G.degrees, G.labels)
+
+
+def color_refinement(G: "Graph",
+                     reset_colors=True,
+                     splitters=None,
+                     sides: "int" = None) -> bool:
+    """
+    Refines the colors of G to the coarsest stable coloring, in which
+    vertices of the same color have equally many neighbors of every color,
+    by edge weight for weighted graphs. Starts from the degrees and vertex
+    labels with reset_colors, else from the current colors.
+    If the current coloring was stable before the cells with the colors in
+    splitters were split off, only those need to be given as splitters.
+    A split cell keeps its color for its largest part, so only the other
+    parts have to be queued as splitters (Hopcroft).
+    For the union of two graphs of sides vertices each, refinement stops
+    and returns False, leaving the colors of G alone, as soon as a color
+    has different numbers of vertices in both graphs, which no further
+    refinement can undo. Otherwise it returns True. Colors other than
+    splitters are taken to be balanced already.
+    """
+    colors = initial_colors(G) if reset_colors else list(G.colors)
+    cells = {}
+    for v, c in enumerate(colors):
+        if c in cells:
+            cells[c].append(v)
         else:
-            key = v.color
-
-        if key in color_classes.keys():
-            color_classes[key].add(v.i)
-        else:
-            color_classes[key] = set([v.i])
-
-
-    #TODO color_classes going from 0 to n
-
-    #TODO Choice of color_classes for initial queue
-    #color_stack = deque([next(iter(color_classes.keys()))])
-    color_stack = deque(
-        sorted([k for k, _ in color_classes.items()],
-               key=lambda c: len(color_classes[c])))
-
-    while color_stack:
-        # Choose the color class with the lowest amount of vertices
-        color_class = color_stack[0]
-
-        # The set of vertices on which the others are split on
-        split_set = color_classes[color_class]
-        n = len(split_set)
-
-        # Get all other color classes and check them on number of neighbors
-        # in the set of vertices that is being split
-        # then define new partitions
-        for cc, verts in color_classes.copy().items():
-            # The D_n's for this color class cc
-            D = [False] * (n + 1)
-            for v in verts:
-                nb = set(G.neighbors[v])
-                nb = nb.intersection(split_set)
-                i = len(nb)
-                if not D[i]:
-                    D[i] = set()
-                D[i].add(v)
-
-            # Clean up empty sets
-            #D = [d for d in D if d]
-
-            # Split up cc into subpartitions from D
-            first_iter = True
-            for d in D:
-                if not d:
-                    continue
-                if first_iter:
-                    color_classes[cc] = d
-                    first_iter = False
-                    continue
-
-                new_color = max(color_classes.keys()) + 1
-                color_classes[new_color] = d
-
-                if cc in color_stack:
-                    color_stack.append(new_color)
+            cells[c] = [v]
+    next_color = max(cells, default=-1) + 1
+
+    if splitters is None:
+        splitters = sorted(cells, key=lambda c: len(cells[c]))
+    # Vertices below first_side belong to the first graph, of the initial
+    # colors only the splitters can be out of balance
+    first_side = 0 if sides is None else sides
+    if sides is not None and any(
+            2 * sum(v < sides for v in cells[c]) != len(cells[c])
+            for c in splitters):
+        return False
+    queue = deque(splitters)
+    # Count of the vertices without neighbors in the splitter
+    zero = () if G.is_weighted else 0
+
+    while queue:
+        counts = neighbor_counts(G, cells[queue.popleft()])
+
+        # Split every color class by the number of neighbors in the splitter
+        touched = {}
+        for v in counts:
+            c = colors[v]
+            if c in touched:
+                touched[c].append(v)
+            else:
+                touched[c] = [v]
+
+        for c in sorted(touched):
+            parts = {}
+            for v in touched[c]:
+                k = counts[v]
+                if k in parts:
+                    parts[k].append(v)
                 else:
-                    push_c = new_color
-                    if len(color_classes[cc]) < len(color_classes[new_color]):
-                        push_c = cc
-
-                    for i, c in enumerate(color_stack):
-                        if len(color_classes[push_c]) < len(color_classes[c]):
-                            color_stack.insert(i, push_c)
-                            break
-
-        color_stack.remove(color_class)
-
-    # Map label to vertice for easy color assignment
-    verts = {v.i: v for v in G.vertices}
-    for c, vs in color_classes.items():
-        for v in vs:
-            verts[v].change_color(c)
+                    parts[k] = [v]
+            if len(touched[c]) < len(cells[c]):
+                parts[zero] = [v for v in cells[c] if v not in counts]
+            if len(parts) == 1:
+                continue
+
+            order = sorted(parts)
+            keep = max(order, key=lambda k: len(parts[k]))
+            for k in order:
+                if k == keep:
+                    cells[c] = parts[k]
+                    continue
+                cells[next_color] = parts[k]
+                first = 0
+                for v in parts[k]:
+                    colors[v] = next_color
+                    if v < first_side:
+                        first += 1
+                # The kept part is balanced if all others are
+                if sides is not None and 2 * first != len(parts[k]):
+                    return False
+                queue.append(next_color)
+                next_color += 1
+
+    G.colors[:] = colors
+    return True
+
+
+def batch_refinement(graphs: "List[Graph]"):
+    """
+    Refines the disjoint union of all graphs at once, so that every graph
+    gets its stable coloring under color names that are consistent across
+    all of them. Returns the color histogram and the stable coloring of
+    every graph, graphs with different histograms are not isomorphic. The
+    colors of the graphs themselves are left alone, the colorings are only
+    comparable with each other.
+    """
+    # Dense graphs are refined through their complement, graphs with equal
+    # numbers of edges are treated alike
+    U = DisjointUnion(*(sparser(G) for G in graphs))
+    color_refinement(U)
+
+    histograms = list()
+    colorings = list()
+    for side in U.split_disjoint():
+        colorings.append(list(side.colors))
+        histograms.append(tuple(sorted(Counter(side.colors).items())))
+    return histograms, colorings
+
+
+def pair_colors(G: "Graph", colors: "List[int]") -> List[int]:
+    """
+    2-dimensional Weisfeiler-Leman refinement of the graph G starting from
+    colors: colors all pairs of vertices and refines the color of (u, v) by
+    the multiset of colors of (u, w) and (w, v) over all w. Returns the
+    colors of the (v, v) pairs, named by hashing, not ranking, so that the
+    colors of different graphs can be compared as long as they start from
+    the same set of colors. Results are kept per graph and starting
+    partition, so colorings that only differ in their names share them.
+    """
+    ranks = {c: i for i, c in enumerate(sorted(set(colors)))}
+    key = tuple(ranks[c] for c in colors)
+    known = _pair_colors.setdefault(G, dict())
+    if key in known:
+        return known[key]
+
+    n = G.size
+    C = list()
+    for u in range(n):
+        nb = set(G.neighbors[u])
+        if G.is_weighted:
+            row = [
+                hash((0, 1 + label_id(G.weight(u, w)))) if w in nb else
+                hash((0, 0)) for w in range(n)
+            ]
+        else:
+            row = [hash((0, 1)) if w in nb else hash((0, 0)) for w in range(n)]
+        row[u] = hash((1, key[u]))
+        C.append(row)
+    classes = len(set(chain.from_iterable(C)))
+
+    while True:
+        # Rows of C and columns of C, zipped per pair in one sort each
+        Ct = [list(col) for col in zip(*C)]
+        C = [[hash((C[u][v], tuple(sorted(zip(C[u], Ct[v])))))
+              for v in range(n)] for u in range(n)]
+        new_classes = len(set(chain.from_iterable(C)))
+        if new_classes == classes:
+            break
+        classes = new_classes
+
+    if len(known) >= WL2_CACHE_SIZE:
+        del known[next(iter(known))]
+    known[key] = [C[u][u] for u in range(n)]
+    return known[key]
+
+
+def pair_refinement(G: "Graph",
+                    colors: "List[int]" = None,
+                    max_vertices: "int" = WL2_MAX_VERTICES) -> bool:
+    """
+    Refines the current colors of G by the 2-WL colors of its vertices,
+    computed from colors, by default the current colors. The graphs of a
+    disjoint union are refined one by one from their part of colors.
+    Returns False, leaving the colors alone, if a graph is too large.
+    """
+    if colors is None:
+        colors = list(G.colors)
+    graphs = G.graphs if G.dsu else (G, )
+    offsets = G.offsets if G.dsu else (0, )
+    if any(H.size > max_vertices for H in graphs):
+        return False
+
+    pairs = list()
+    for H, offset in zip(graphs, offsets):
+        pairs.extend(
+            zip(G.colors[offset:offset + H.size],
+                pair_colors(H, colors[offset:offset + H.size])))
+    ids = {c: i for i, c in enumerate(sorted(set(pairs)))}
+    G.colors[:] = [ids[c] for c in pairs]
+    return True
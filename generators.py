@@ -0,0 +1,360 @@
+"""
+Synthetic graph families of arbitrary size for stress and scaling tests.
+Every generator returns a Graph built directly from its neighbor lists, the
+random ones take a seed. Run as a script to write them as .grl files or to
+time refinement, isomorphism tests and automorphism counts per size:
+
+    python generators.py torus 100 200 400 --bench --timeout 60
+    python generators.py regular 100000 --degree 3 --copies 2 -o reg.grl
+"""
+import argparse
+import sys
+from heapq import heapify, heappop, heappush
+from itertools import combinations
+from random import Random
+from time import perf_counter
+from graph_adj import *
+from graph_io_adj import from_neighbors, write_graph_list
+
+
+def from_edges(n: "int", edges: "Iterable[tuple]") -> Graph:
+    """
+    Builds a graph on n vertices from edges without loops or duplicates
+    """
+    neighbors = [[] for _ in range(n)]
+    for u, v in edges:
+        neighbors[u].append(v)
+        neighbors[v].append(u)
+    return from_neighbors(neighbors)
+
+
+def relabeled(G: "Graph", seed: "int" = None) -> Graph:
+    """
+    Returns a copy of G with its vertices randomly renumbered, which keeps
+    labels and weights
+    """
+    perm = list(range(G.size))
+    Random(seed).shuffle(perm)
+    neighbors = [None] * G.size
+    for v, nb in enumerate(G.neighbors):
+        neighbors[perm[v]] = [perm[w] for w in nb]
+    H = from_neighbors(neighbors)
+    if G.weights is not None:
+        H.weights = {(min(perm[i], perm[j]), max(perm[i], perm[j])): w
+                     for (i, j), w in G.weights.items()}
+    if G.labels is not None:
+        for v, label in enumerate(G.labels):
+            H.set_label(perm[v], label)
+    return H
+
+
+def random_regular(n: "int", d: "int" = 3, seed: "int" = None) -> Graph:
+    """
+    Random d-regular graph on n vertices from the pairing model. Loops and
+    double edges are switched away with random other pairs instead of
+    starting over, so the distribution is close to but not exactly uniform.
+    """
+    if n * d % 2 or d >= n:
+        raise ValueError("No {}-regular graph on {} vertices".format(d, n))
+    rng = Random(seed)
+    points = [v for v in range(n) for _ in range(d)]
+    rng.shuffle(points)
+    pairs = [[points[k], points[k + 1]] for k in range(0, len(points), 2)]
+
+    count = {}
+    for u, v in pairs:
+        e = (min(u, v), max(u, v))
+        count[e] = count.get(e, 0) + 1
+
+    def bad(p):
+        u, v = p
+        return u == v or count[min(u, v), max(u, v)] > 1
+
+    def move(p, delta):
+        e = (min(p), max(p))
+        count[e] = count.get(e, 0) + delta
+
+    todo = [k for k, p in enumerate(pairs) if bad(p)]
+    while todo:
+        k = todo.pop()
+        if not bad(pairs[k]):
+            continue
+        # Swap an end with a random other pair
+        l = rng.randrange(len(pairs))
+        p, q = pairs[k], pairs[l]
+        move(p, -1)
+        move(q, -1)
+        p[1], q[0] = q[0], p[1]
+        move(p, 1)
+        move(q, 1)
+        todo.extend((k, l))
+    return from_edges(n, map(tuple, pairs))
+
+
+def random_tree(n: "int", seed: "int" = None) -> Graph:
+    """
+    Uniformly random tree on n vertices, decoded from a random Pruefer
+    sequence
+    """
+    if n <= 2:
+        return from_edges(n, [(0, 1)] if n == 2 else [])
+    rng = Random(seed)
+    code = [rng.randrange(n) for _ in range(n - 2)]
+    degree = [1] * n
+    for v in code:
+        degree[v] += 1
+    leaves = [v for v in range(n) if degree[v] == 1]
+    heapify(leaves)
+    edges = list()
+    for v in code:
+        leaf = heappop(leaves)
+        edges.append((leaf, v))
+        degree[v] -= 1
+        if degree[v] == 1:
+            heappush(leaves, v)
+    edges.append((heappop(leaves), heappop(leaves)))
+    return from_edges(n, edges)
+
+
+def hypercube(d: "int") -> Graph:
+    n = 1 << d
+    return from_edges(n, ((v, v ^ 1 << b) for v in range(n) for b in range(d)
+                          if v < v ^ 1 << b))
+
+
+def torus(a: "int", b: "int" = None) -> Graph:
+    """
+    The a x b grid with wrap around, square by default
+    """
+    b = a if b is None else b
+    if a < 3 or b < 3:
+        raise ValueError("A torus needs at least 3 x 3 vertices")
+    edges = list()
+    for i in range(a):
+        for j in range(b):
+            v = i * b + j
+            edges.append((v, i * b + (j + 1) % b))
+            edges.append((v, (i + 1) % a * b + j))
+    return from_edges(a * b, edges)
+
+
+def random_cycles(k: "int", seed: "int" = None) -> List[int]:
+    """
+    Random lengths of at least 3 that add up to k
+    """
+    if k < 3:
+        raise ValueError("Cycles need at least 3 vertices, not {}".format(k))
+    rng = Random(seed)
+    lengths = list()
+    while k:
+        length = rng.randint(3, k)
+        if k - length < 3:
+            length = k
+        lengths.append(length)
+        k -= length
+    return lengths
+
+
+def wheel_join(cycles: "List[int]") -> Graph:
+    """
+    The join of a single vertex, the last one, and disjoint cycles of the
+    given lengths, as in wheeljoin*.grl
+    """
+    k = sum(cycles)
+    edges = [(v, k) for v in range(k)]
+    start = 0
+    for length in cycles:
+        edges.extend((start + v, start + (v + 1) % length)
+                     for v in range(length))
+        start += length
+    return from_edges(k + 1, edges)
+
+
+def wheel_star(wheels: "List[List[int]]") -> Graph:
+    """
+    Wheel joins with the given cycle lengths whose centers are adjacent to
+    one more vertex, the last one, as in wheelstar*.grl
+    """
+    neighbors = list()
+    hubs = list()
+    for cycles in wheels:
+        W = wheel_join(cycles)
+        offset = len(neighbors)
+        neighbors.extend([offset + w for w in nb] for nb in W.neighbors)
+        hubs.append(len(neighbors) - 1)
+    center = len(neighbors)
+    for hub in hubs:
+        neighbors[hub].append(center)
+    neighbors.append(hubs)
+    return from_neighbors(neighbors)
+
+
+def three_paths(k: "int") -> Graph:
+    """
+    Three paths of k - 1, k and k + 1 edges between the vertices 0 and
+    k - 1, plus a vertex hanging off 0: 3k vertices, as in threepaths*.gr
+    """
+    if k < 2:
+        raise ValueError("Three paths need k >= 2, not {}".format(k))
+    n = 3 * k
+    s, t = 0, k - 1
+    edges = list()
+    next_vertex = 1
+    for length in (k - 1, k, k + 1):
+        prev = s
+        for _ in range(length - 1):
+            v = t + 1 if next_vertex == t else next_vertex
+            next_vertex = v + 1
+            edges.append((prev, v))
+            prev = v
+        edges.append((prev, t))
+    edges.append((s, n - 1))
+    return from_edges(n, edges)
+
+
+def cfi(base: "Graph", twisted: "bool" = False) -> Graph:
+    """
+    Cai-Fuerer-Immerman graph of base: every vertex of base becomes a
+    gadget with two vertices per incident edge and a vertex for every even
+    subset of its edges, gadgets are joined along the edges of base. With
+    twisted, one edge crosses its pairs. For a connected base the plain
+    and the twisted graph are not isomorphic, yet color refinement cannot
+    tell them apart.
+    """
+    ends = {}
+    n = 0
+    edges = list()
+    for v, nb in enumerate(base.neighbors):
+        # Vertices n + 2i and n + 2i + 1 stand for the edge to nb[i]
+        for i, w in enumerate(nb):
+            ends[v, w] = n + 2 * i
+        middle = n + 2 * len(nb)
+        for size in range(0, len(nb) + 1, 2):
+            for subset in combinations(range(len(nb)), size):
+                for i in range(len(nb)):
+                    edges.append((middle, n + 2 * i + (i in subset)))
+                middle += 1
+        n = middle
+
+    twist = True
+    for v, nb in enumerate(base.neighbors):
+        for w in nb:
+            if v < w:
+                a, b = ends[v, w], ends[w, v]
+                if twisted and twist:
+                    edges.extend(((a, b + 1), (a + 1, b)))
+                    twist = False
+                else:
+                    edges.extend(((a, b), (a + 1, b + 1)))
+    return from_edges(n, edges)
+
+
+def cfi_pair(n: "int", seed: "int" = None):
+    """
+    Plain and twisted CFI graph over a random 3-regular base on n vertices
+    """
+    base = random_regular(n, 3, seed)
+    return cfi(base), cfi(base, twisted=True)
+
+
+# Family name -> function of (size, degree, seed) returning a graph
+FAMILIES = {
+    "regular": lambda n, d, seed: random_regular(n, d, seed),
+    "tree": lambda n, d, seed: random_tree(n, seed),
+    "hypercube": lambda n, d, seed: hypercube(n),
+    "torus": lambda n, d, seed: torus(n),
+    "cfi": lambda n, d, seed: cfi_pair(n, seed)[0],
+    "wheeljoin": lambda n, d, seed: wheel_join(random_cycles(n, seed)),
+    "wheelstar": lambda n, d, seed: wheel_star(
+        [random_cycles(n, None if seed is None else seed + i)
+         for i in range(3)]),
+    "threepaths": lambda n, d, seed: three_paths(n),
+}
+
+
+def timed(f, *args, **kwargs):
+    start = perf_counter()
+    result = f(*args, **kwargs)
+    return result, perf_counter() - start
+
+
+def short_count(count) -> str:
+    if count is None:
+        return "undecided"
+    digits = len(str(count))
+    return str(count) if digits <= 12 else "~1e{}".format(digits - 1)
+
+
+def bench(family: "str", sizes: "List[int]", degree: "int", seed: "int",
+          timeout: "float", parallel: "int"):
+    """
+    Prints one line per size: vertices, edges, the seconds it took to
+    generate the graph, to refine it, to test it against a relabeled copy
+    (for cfi against the twisted graph) and to count its automorphisms,
+    the search nodes of the last two and their results
+    """
+    from fast_col_ref import color_refinement
+    from is_iso import is_iso
+    from count_aut import count_aut
+    from graph_lib import Budget
+
+    print("size vertices edges generate refine iso nodes aut nodes "
+          "isomorphic automorphisms")
+    for size in sizes:
+        G, t_gen = timed(FAMILIES[family], size, degree, seed)
+        if family == "cfi":
+            H = cfi_pair(size, seed)[1]
+        else:
+            H = relabeled(G, seed)
+        colors = G.colors
+        G.colors = list(colors)
+        _, t_ref = timed(color_refinement, G)
+        G.colors = colors
+
+        iso_budget = Budget(timeout)
+        iso, t_iso = timed(is_iso, G, H, iso_budget, parallel=parallel)
+        aut_budget = Budget(timeout)
+        aut, t_aut = timed(count_aut, G, aut_budget, parallel=parallel)
+        print("{} {} {} {:.2f} {:.2f} {:.2f} {} {:.2f} {} {} {}".format(
+            size, G.size, G.num_edges, t_gen, t_ref, t_iso,
+            iso_budget.nodes, t_aut, aut_budget.nodes,
+            "undecided" if iso is None else iso, short_count(aut)),
+              flush=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Generate graph families or time the solver on them")
+    parser.add_argument("family", choices=list(FAMILIES))
+    parser.add_argument("sizes", type=int, nargs="+")
+    parser.add_argument("--degree", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--copies",
+                        type=int,
+                        default=1,
+                        help="Randomly relabeled copies per size")
+    parser.add_argument("-o", "--output")
+    parser.add_argument("--bench", action="store_true")
+    parser.add_argument("--timeout", type=float)
+    parser.add_argument("--parallel", type=int)
+    args = parser.parse_args()
+
+    try:
+        if args.bench:
+            bench(args.family, args.sizes, args.degree, args.seed,
+                  args.timeout, args.parallel)
+            sys.exit()
+
+        graphs = list()
+        for size in args.sizes:
+            G = FAMILIES[args.family](size, args.degree, args.seed)
+            graphs.append(G)
+            graphs.extend(
+                relabeled(G, args.seed + k) for k in range(1, args.copies))
+    except ValueError as e:
+        parser.error(str(e))
+    if args.output:
+        with open(args.output, "w") as f:
+            write_graph_list(graphs, f)
+    else:
+        write_graph_list(graphs, sys.stdout)
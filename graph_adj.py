@@ -1,6 +1,9 @@
-from typing import List
+from typing import List, Iterable
 from collections import deque
+from collections.abc import Sequence
+from bisect import bisect_right
 from enum import Enum
+from itertools import islice
 from math import inf
 from collections import deque
 
@@ -12,12 +15,39 @@ class Twin(Enum):
 
 
 class Edge:
-    def __init__(self, head: "int", tail: "int"):
+    def __init__(self, head: "int", tail: "int", weight=None):
         self.head = head
         self.tail = tail
+        self.weight = weight
+
+
+# Label or edge weight -> small int, shared by all graphs of the process so
+# that equal labels of different graphs get equal ids. None is 0.
+label_ids = {None: 0}
+
+
+def label_id(label) -> int:
+    if label not in label_ids:
+        label_ids[label] = len(label_ids)
+    return label_ids[label]
+
+
+def with_labels(colors: "List[int]", labels: "List") -> List[int]:
+    """
+    Refines colors by the vertex labels, the (color, label) pairs are named
+    by their rank
+    """
+    pairs = [(c, label_id(l)) for c, l in zip(colors, labels)]
+    ids = {p: i for i, p in enumerate(sorted(set(pairs)))}
+    return [ids[p] for p in pairs]
 
 
 class Vertex:
+    """
+    Lightweight view on vertex i of a graph, all data lives in the graph
+    """
+    __slots__ = ("i", "_graph")
+
     def __init__(self, graph: "Graph", i: "int"):
         self.i = i
         self._graph = graph
@@ -27,15 +57,12 @@ class Vertex:
 
     @property
     def neighbors(self) -> List["Vertex"]:
-        verts = list()
-        for i, v in enumerate(self._graph.adj_matrix[self.i]):
-            if v:
-                verts.append(Vertex(self._graph, i))
-        return verts
+        verts = self._graph.vertices
+        return [verts[j] for j in sorted(self._graph.neighbors[self.i])]
 
     @property
     def degree(self) -> int:
-        return [1 for x in self._graph.adj_matrix[self.i] if x].count(1)
+        return self._graph.degrees[self.i]
 
     @property
     def color(self) -> int:
@@ -73,92 +100,148 @@ class Graph:
 
         self.size = n
         self.abs_size = n
-        # Init matrix
-        self.adj_matrix = [[] for _ in range(self.size)]
-        for i in range(self.size):
-            self.adj_matrix[i] = [False] * self.size
+        # Adjacency bitsets: bit j of adj_rows[i] is set iff i and j are
+        # adjacent. None until first use for graphs built from neighbor
+        # lists, large sparse graphs never need them.
+        self._adj_rows = [0] * self.size
 
         self.colors = [0] * self.size
         self.dsu = False
         self.neighbors = [[] for _ in range(self.size)]
+        # Vertex labels and (i, j) -> edge weight for i <= j, None as long
+        # as the graph has none
+        self.labels = None
+        self.weights = None
+
+        # Derived data, computed on first use and kept up to date (or
+        # dropped) by add_edge. Code that fills adj_rows and neighbors
+        # directly has to do so before using any of it.
+        self._vertices = None
+        self._degrees = None
+        self._num_edges = None
+        self._edges = None
+        self._is_connected = None
+        self._complement = None
 
     @property
     def vertices(self) -> List["Vertex"]:
-        return [Vertex(self, i) for i in range(self.abs_size)]
+        """
+        Views on all vertices, the same list is returned on every call
+        """
+        if self._vertices is None or len(self._vertices) != self.abs_size:
+            self._vertices = [Vertex(self, i) for i in range(self.abs_size)]
+        return self._vertices
 
     @property
-    def edges(self) -> List["Edge"]:
-        edges = list()
-        for i, v in enumerate(self.adj_matrix):
-            for j, e in enumerate(v[:i]):
-                if e:
-                    edges.append(Edge(i, j))
+    def adj_rows(self) -> List[int]:
+        if self._adj_rows is None:
+            n = self.abs_size
+            self._adj_rows = [bitmask(nb, n) for nb in self.neighbors]
+        return self._adj_rows
 
-        return edges
+    @adj_rows.setter
+    def adj_rows(self, rows: "List[int]"):
+        self._adj_rows = rows
 
-    def is_connected(self):
-        return len(self.edges) == (self.abs_size * (self.abs_size - 1)) // 2
-
-    def add_edge(self, edge: "Edge"):
-        if edge.head >= self.abs_size or edge.tail >= self.abs_size:
-            return
+    @property
+    def degrees(self) -> List[int]:
+        # A loop is listed once, as it is set once in its row
+        if self._degrees is None:
+            self._degrees = [len(nb) for nb in self.neighbors]
+        return self._degrees
 
-        self.adj_matrix[edge.head][edge.tail] = True
-        self.adj_matrix[edge.tail][edge.head] = True
-        self.neighbors[edge.head].append(edge.tail)
-        self.neighbors[edge.tail].append(edge.head)
+    @property
+    def num_edges(self) -> int:
+        if self._num_edges is None:
+            self._num_edges = sum(
+                1 for i, nb in enumerate(self.neighbors) for j in nb if j < i)
+        return self._num_edges
 
-    def __add__(self, other: "Graph") -> "Graph":
-        if self.dsu:
-            raise Exception("Graph is already a DSU")
+    @property
+    def edges(self) -> List["Edge"]:
+        if self._edges is None:
+            self._edges = [
+                Edge(i, j, self.weight(i, j))
+                for i, nb in enumerate(self.neighbors) for j in sorted(nb)
+                if j < i
+            ]
+        return self._edges
 
-        new = Graph(self.size)
-        new.dsu = True
-        new.abs_size = new.size + other.size
-        new.adj_matrix = self.adj_matrix.copy()
-        new.colors = self.colors.copy()
-        new.colors.extend(other.colors)
-        new.neighbors = self.neighbors.copy()
-        new.neighbors.extend([[] for _ in range(other.size)])
+    def is_connected(self):
+        return len(self.edges) == (self.abs_size * (self.abs_size - 1)) // 2
 
-        for _ in range(other.size):
-            new.adj_matrix.append([False] * new.size)
-        for c in new.adj_matrix:
-            c.extend([False] * other.size)
+    @property
+    def is_labeled(self) -> bool:
+        """
+        Whether the graph has vertex labels or edge weights, which
+        isomorphisms have to preserve
+        """
+        return self.labels is not None or self.weights is not None
 
-        for e in other.edges:
-            new.add_edge(Edge(e.head + self.size, e.tail + self.size))
+    @property
+    def is_weighted(self) -> bool:
+        return self.weights is not None
 
-        return new
+    def label(self, i: "int"):
+        return None if self.labels is None else self.labels[i]
 
-    def split_disjoint(self):
-        if not self.dsu:
-            raise Exception("Graph is not a DSU")
+    def set_label(self, i: "int", label):
+        if i >= self.abs_size or label is None and self.labels is None:
+            return
+        if self.labels is None:
+            self.labels = [None] * self.abs_size
+        self.labels[i] = label
+        self._complement = None
 
-        other_size = self.abs_size - self.size
-        A = Graph(self.size)
-        B = Graph(other_size)
+    def weight(self, i: "int", j: "int"):
+        if self.weights is None:
+            return None
+        return self.weights.get((i, j) if i <= j else (j, i))
 
-        A.colors = self.colors[:self.size]
-        B.colors = self.colors[self.size:]
+    def add_edge(self, edge: "Edge"):
+        if edge.head >= self.abs_size or edge.tail >= self.abs_size:
+            return
+        # Graphs without bitsets yet keep them unbuilt
+        rows = self._adj_rows
+        if rows is None:
+            if edge.tail in self.neighbors[edge.head]:
+                return
+        elif rows[edge.head] >> edge.tail & 1:
+            return
 
-        A.neighbors = self.neighbors[:self.size]
-        B.neighbors = [[n - self.size for n in nb]
-                       for nb in self.neighbors[self.size:]]
+        if edge.weight is not None:
+            if self.weights is None:
+                self.weights = {}
+            self.weights[min(edge.head, edge.tail),
+                         max(edge.head, edge.tail)] = edge.weight
 
-        for i, c in enumerate(self.adj_matrix[:self.size]):
-            A.adj_matrix[i] = c[:self.size]
+        if rows is not None:
+            rows[edge.head] |= 1 << edge.tail
+            rows[edge.tail] |= 1 << edge.head
+        self.neighbors[edge.head].append(edge.tail)
+        if edge.head == edge.tail:
+            if self._degrees is not None:
+                self._degrees[edge.head] += 1
+        else:
+            self.neighbors[edge.tail].append(edge.head)
+            if self._degrees is not None:
+                self._degrees[edge.head] += 1
+                self._degrees[edge.tail] += 1
+            if self._num_edges is not None:
+                self._num_edges += 1
 
-        for i, c in enumerate(self.adj_matrix[self.size:]):
-            B.adj_matrix[i] = c[self.size:]
+        self._edges = None
+        self._is_connected = None
+        self._complement = None
 
-        return A, B
+    def __add__(self, other: "Graph") -> "DisjointUnion":
+        return DisjointUnion(self, other)
 
     def is_adjacent(self, u: "Vertex", v: "Vertex") -> bool:
         if u.i >= self.size or v.i >= self.size:
             return False
 
-        return self.adj_matrix[u.i][v.i]
+        return self.adj_rows[u.i] >> v.i & 1 == 1
 
     @property
     def max_color(self):
@@ -200,9 +283,8 @@ class Graph:
         return false_twins
 
     def degree_of_color(self, b):
-        for i, c in enumerate(self.colors):
-            if c == b:
-                return self.vertices[i].degree
+        if b in self.colors:
+            return self.degrees[self.colors.index(b)]
         return 0
 
     # TODO test everything here
@@ -237,16 +319,45 @@ class Graph:
     def is_connected(self):
         if self.dsu:
             return False
-        label, parent, dist = self.graph_search(self.vertices[0])
-        return self.size == max(label.values())
+        if self._is_connected is None:
+            label, parent, dist = self.graph_search(self.vertices[0])
+            self._is_connected = self.size == max(label.values())
+        return self._is_connected
 
     def is_tree(self):
-        return self.is_connected and len(self.edges) == self.size - 1
+        return self.is_connected and self.num_edges == self.size - 1
+
+    def complement(self) -> "Graph":
+        """
+        Returns the complement of the graph, which keeps the loops and vertex
+        labels. It has the same automorphisms and is kept until an edge or
+        label is added.
+        """
+        if self._complement is None:
+            n = self.abs_size
+            full = (1 << n) - 1
+            C = Graph(n)
+            C.adj_rows = [
+                row ^ full ^ 1 << i for i, row in enumerate(self.adj_rows)
+            ]
+            C.neighbors = [bits_of(row) for row in C.adj_rows]
+            if self.labels is not None:
+                C.labels = list(self.labels)
+            self._complement = C
+        return self._complement
+
+    @property
+    def is_dense(self) -> bool:
+        """
+        Whether the graph has more than half of all possible edges
+        """
+        v = self.abs_size
+        return self.num_edges > v * (v - 1) // 4
 
     def is_complete(self):
-        v = len(self.vertices)
+        v = self.abs_size
 
-        return len(self.edges) == (v * (v - 1) / 2)
+        return self.num_edges == (v * (v - 1) / 2)
 
     def find_center(self):
         root = self.vertices[0]  # take 'random' root
@@ -308,6 +419,197 @@ class Graph:
         return subtree
 
 
+def sparser(G: "Graph") -> "Graph":
+    """
+    Returns G, or its complement with a copy of the colors of G if that has
+    fewer edges. Both have the same isomorphisms and automorphisms, and a
+    stable coloring of one is stable for the other. Weighted graphs are
+    never complemented.
+    """
+    if not G.is_dense or G.is_weighted:
+        return G
+    C = G.complement()
+    C.colors = list(G.colors)
+    return C
+
+
+def bits_of(row: "int") -> List[int]:
+    """
+    Returns the positions of the set bits of row in increasing order
+    """
+    return [i for i, b in enumerate(reversed(bin(row)[2:])) if b == "1"]
+
+
+def bitmask(vertices: "List[int]", n: "int") -> int:
+    """
+    Returns the bitset of the given vertices out of n
+    """
+    if len(vertices) < 64:
+        mask = 0
+        for v in vertices:
+            mask |= 1 << v
+        return mask
+    bits = bytearray((n >> 3) + 1)
+    for v in vertices:
+        bits[v >> 3] |= 1 << (v & 7)
+    return int.from_bytes(bits, "little")
+
+
+class DisjointUnion:
+    """
+    View on the disjoint union of graphs without copying them: vertex i
+    of the k-th graph is vertex offsets[k] + i of the union, so for two
+    graphs vertex i < size is in the left one. All sides share the colors
+    list of the union.
+    """
+
+    def __init__(self, *graphs: "Graph"):
+        if any(G.dsu for G in graphs):
+            raise Exception("Graph is already a DSU")
+
+        self.graphs = graphs
+        self.offsets = [0]
+        for G in graphs:
+            self.offsets.append(self.offsets[-1] + G.size)
+        self.size = graphs[0].size
+        self.abs_size = self.offsets[-1]
+        self.dsu = True
+        self.colors = [c for G in graphs for c in G.colors]
+        # Labeled vertices start apart from differently labeled ones
+        self.labels = None
+        if any(G.labels is not None for G in graphs):
+            self.labels = [
+                l for G in graphs for l in (G.labels or [None] * G.size)
+            ]
+            self.colors = with_labels(self.colors, self.labels)
+        self.is_weighted = any(G.is_weighted for G in graphs)
+        self.neighbors = UnionNeighbors(self)
+        self.degrees = [d for G in graphs for d in G.degrees]
+        self.vertices = [Vertex(self, i) for i in range(self.abs_size)]
+        self._adj_rows = None
+
+    @property
+    def adj_rows(self) -> List[int]:
+        """
+        Adjacency bitsets of the union, built on first use
+        """
+        if self._adj_rows is None:
+            self._adj_rows = [
+                row << offset for G, offset in zip(self.graphs, self.offsets)
+                for row in G.adj_rows
+            ]
+        return self._adj_rows
+
+    def __add__(self, other):
+        raise Exception("Graph is already a DSU")
+
+    def locate(self, i: "int"):
+        """
+        Returns the position of the graph vertex i belongs to and its offset
+        """
+        k = bisect_right(self.offsets, i) - 1
+        return k, self.offsets[k]
+
+    def split_disjoint(self):
+        return tuple(
+            UnionSide(self, G, offset)
+            for G, offset in zip(self.graphs, self.offsets))
+
+    def weight(self, i: "int", j: "int"):
+        k, offset = self.locate(i)
+        return self.graphs[k].weight(i - offset, j - offset)
+
+    def is_adjacent(self, u: "Vertex", v: "Vertex") -> bool:
+        k, offset = self.locate(u.i)
+        if not offset <= v.i < self.offsets[k + 1]:
+            return False
+        return self.graphs[k].adj_rows[u.i - offset] >> v.i - offset & 1 == 1
+
+    @property
+    def max_color(self):
+        return max(self.colors)
+
+
+class UnionNeighbors(Sequence):
+    """
+    Neighbor lists of a disjoint union, the ones of all but the first
+    graph are shifted on access
+    """
+    __slots__ = ("_union", )
+
+    def __init__(self, union: "DisjointUnion"):
+        self._union = union
+
+    def __len__(self):
+        return self._union.abs_size
+
+    def __getitem__(self, i):
+        if i < self._union.size:
+            return self._union.graphs[0].neighbors[i]
+        k, offset = self._union.locate(i)
+        return [offset + j for j in self._union.graphs[k].neighbors[i - offset]]
+
+
+class ColorSlice(Sequence):
+    """
+    Colors of one side of a disjoint union, reads and writes go to the
+    current colors list of the union
+    """
+    __slots__ = ("_union", "_start", "_stop")
+
+    def __init__(self, union: "DisjointUnion", start: "int", stop: "int"):
+        self._union = union
+        self._start = start
+        self._stop = stop
+
+    def __len__(self):
+        return self._stop - self._start
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return list(islice(self, *i.indices(len(self))))
+        return self._union.colors[self._start + i]
+
+    def __setitem__(self, i, c):
+        self._union.colors[self._start + i] = c
+
+    def __iter__(self):
+        return islice(self._union.colors, self._start, self._stop)
+
+    def index(self, c):
+        return self._union.colors.index(c, self._start,
+                                        self._stop) - self._start
+
+
+class UnionSide:
+    """
+    One side of a disjoint union, indexed like the original graph but with
+    the colors of the union
+    """
+
+    def __init__(self, union: "DisjointUnion", graph: "Graph",
+                 offset: "int"):
+        self.graph = graph
+        self.size = graph.size
+        self.colors = ColorSlice(union, offset, offset + graph.size)
+        self.neighbors = graph.neighbors
+        self.degrees = graph.degrees
+        self._vertices = None
+
+    @property
+    def vertices(self) -> List["Vertex"]:
+        if self._vertices is None:
+            self._vertices = [Vertex(self, i) for i in range(self.size)]
+        return self._vertices
+
+    def is_adjacent(self, u: "Vertex", v: "Vertex") -> bool:
+        return self.graph.is_adjacent(u, v)
+
+    @property
+    def max_color(self):
+        return max(self.colors)
+
+
 # Test function
 if __name__ == "__main__":
     from graph_io_adj import write_dot, load_graph_list
@@ -1,4 +1,9 @@
+import re
 import sys
+import gzip
+import lzma
+from math import isqrt
+from concurrent.futures import ProcessPoolExecutor
 from graph_adj import *
 from typing import List, IO
 
@@ -15,34 +20,79 @@ def read_line(f: IO[str]) -> str:
     return line
 
 
+def parse_line(line: "str"):
+    """
+    Parses an edge line u,v or u,v:weight into an Edge and a vertex label
+    line v:label into a (v, label) pair, raises ValueError for other lines
+    """
+    comma = line.find(',')
+    colon = line.find(':')
+    if comma < 0:
+        if colon < 0:
+            raise ValueError("Not an edge or label: {}".format(line))
+        return int(line[:colon]), line[colon + 1:].strip()
+    elif colon >= 0:
+        return Edge(int(line[:comma]), int(line[comma + 1:colon]),
+                    int(line[colon + 1:]))
+    return Edge(int(line[:comma]), int(line[comma + 1:]))
+
+
+def build_graph(n: "int", items: "List") -> Graph:
+    """
+    Builds the graph on n vertices with the parsed edges and labels of
+    items through its neighbor lists, so that the adjacency bitsets are
+    only built once they are used. Repeated edges are added once with
+    their first weight, edges to vertices past n are dropped.
+    """
+    neighbors = [[] for _ in range(n)]
+    seen = set()
+    weights = {}
+    labels = list()
+    for item in items:
+        if not isinstance(item, Edge):
+            labels.append(item)
+            continue
+        u, v = item.head, item.tail
+        e = (min(u, v), max(u, v))
+        if e[1] >= n or e in seen:
+            continue
+        seen.add(e)
+        neighbors[u].append(v)
+        if u != v:
+            neighbors[v].append(u)
+        if item.weight is not None:
+            weights[e] = item.weight
+
+    graph = from_neighbors(neighbors)
+    if weights:
+        graph.weights = weights
+    for i, label in labels:
+        graph.set_label(i, label)
+    return graph
+
+
 def read_graph(f: IO[str]) -> Graph:
     while True:
+        line = read_line(f)
+        if line == '':
+            raise ValueError("End of file before the number of vertices")
         try:
-            line = read_line(f)
             n = int(line)
-            graph = Graph(n)
             break
         except ValueError:
             pass
 
     line = read_line(f)
-    edges = []
+    items = []
 
     try:
         while True:
-            comma = line.find(',')
-            if ':' in line:
-                colon = line.find(':')
-                edges.append((int(line[:comma]), int(line[comma + 1:colon]),
-                              int(line[colon + 1:])))
-            else:
-                edges.append((int(line[:comma]), int(line[comma + 1:]), None))
+            items.append(parse_line(line))
             line = read_line(f)
     except Exception:
         pass
 
-    for edge in edges:
-        graph.add_edge(Edge(edge[0], edge[1]))
+    graph = build_graph(n, items)
 
     if line != '' and line[0] == '-':
         return graph, True
@@ -50,7 +100,59 @@ def read_graph(f: IO[str]) -> Graph:
         return graph, False
 
 
-def read_graph_list(f: IO[str]) -> List[Graph]:
+def parse_block(block: "str") -> Graph:
+    """
+    Parses the text of a single graph of an edge list file, i.e. the part
+    between two separator lines
+    """
+    lines = (line for line in block.splitlines() if not line.startswith("#"))
+    for line in lines:
+        try:
+            n = int(line)
+            break
+        except ValueError:
+            pass
+    else:
+        return Graph(0)
+
+    items = []
+    for line in lines:
+        try:
+            items.append(parse_line(line))
+        except ValueError:
+            break
+    return build_graph(n, items)
+
+
+def split_blocks(text: "str") -> List[str]:
+    """
+    Splits an edge list file at its separator lines
+    """
+    blocks = re.split(r"^-.*\n?", text, flags=re.MULTILINE)
+    return [b for b in blocks if b.strip()]
+
+
+def parse_parallel(parse, items: "List[str]", jobs: "int") -> list:
+    """
+    Applies parse to all items in jobs worker processes and returns the
+    results in the order of items
+    """
+    if len(items) < 2:
+        return [parse(item) for item in items]
+    with ProcessPoolExecutor(jobs) as pool:
+        return list(
+            pool.map(parse, items, chunksize=max(1,
+                                                 len(items) // (4 * jobs))))
+
+
+def read_graph_list(f: IO[str], jobs: "int" = None) -> List[Graph]:
+    """
+    Reads all graphs of an edge list file, with jobs > 1 the blocks between
+    the separators are parsed in that many processes
+    """
+    if jobs is not None and jobs > 1:
+        return parse_parallel(parse_block, split_blocks(f.read()), jobs)
+
     graphs = list()
 
     cont = True
@@ -60,8 +162,275 @@ def read_graph_list(f: IO[str]) -> List[Graph]:
     return graphs
 
 
-def load_graph_list(f: IO[str]) -> List[Graph]:
-    return read_graph_list(f)
+def from_neighbors(neighbors: "List[List[int]]") -> Graph:
+    """
+    Builds a graph directly from its neighbor lists, which have to be
+    symmetric and free of duplicates. The adjacency bitsets are only built
+    once they are used.
+    """
+    graph = Graph(len(neighbors))
+    graph.neighbors = neighbors
+    graph.adj_rows = None
+    return graph
+
+
+def encode_size(n: "int") -> str:
+    if n < 63:
+        return chr(n + 63)
+    elif n < 1 << 18:
+        return "~" + "".join(chr((n >> s & 63) + 63) for s in (12, 6, 0))
+    return "~~" + "".join(
+        chr((n >> s & 63) + 63) for s in (30, 24, 18, 12, 6, 0))
+
+
+def decode_size(data: "str"):
+    """
+    Returns the number of vertices encoded at the start of data and the
+    rest of data
+    """
+    if data[0] != "~":
+        return ord(data[0]) - 63, data[1:]
+    elif data[1] != "~":
+        length, data = 3, data[1:]
+    else:
+        length, data = 6, data[2:]
+    n = 0
+    for c in data[:length]:
+        n = n << 6 | ord(c) - 63
+    return n, data[length:]
+
+
+# Maps the 6 bit values to the printable characters of graph6 and sparse6
+OFFSET_63 = bytes((b + 63) % 256 for b in range(256))
+
+
+def to_bits(data: "str") -> str:
+    return "".join(format(ord(c) - 63, "06b") for c in data)
+
+
+def from_bits(bits: "str") -> str:
+    bits += "0" * (-len(bits) % 6)
+    return "".join(
+        chr(int(bits[i:i + 6], 2) + 63) for i in range(0, len(bits), 6))
+
+
+def read_graph6(line: "str") -> Graph:
+    """
+    Parses a single graph6 line: the upper triangle of the adjacency matrix
+    column by column, bit p = j (j - 1) / 2 + i standing for the edge {i, j}.
+    Only the characters with bits set are looked at.
+    """
+    n, data = decode_size(line.strip().removeprefix(">>graph6<<"))
+    data = data.encode()
+    total = n * (n - 1) // 2
+    neighbors = [[] for _ in range(n)]
+    for match in re.finditer(b"[^?]", data):
+        k = match.start()
+        value = data[k] - 63
+        for b in range(6):
+            if not value >> 5 - b & 1:
+                continue
+            p = 6 * k + b
+            if p >= total:
+                break
+            j = (1 + isqrt(1 + 8 * p)) // 2
+            i = p - j * (j - 1) // 2
+            neighbors[i].append(j)
+            neighbors[j].append(i)
+    return from_neighbors(neighbors)
+
+
+def sparse6_width(n: "int") -> int:
+    k = 1
+    while 1 << k < n:
+        k += 1
+    return k
+
+
+def read_sparse6(line: "str") -> Graph:
+    """
+    Parses a single sparse6 line: a stream of (b, x) pairs that either
+    move the current vertex v or add the edge {x, v}
+    """
+    n, data = decode_size(
+        line.strip().removeprefix(">>sparse6<<").removeprefix(":"))
+    bits = to_bits(data)
+    k = sparse6_width(n)
+    neighbors = [[] for _ in range(n)]
+    seen = set()
+    v, p = 0, 0
+    while p + 1 + k <= len(bits):
+        if bits[p] == "1":
+            v += 1
+        x = int(bits[p + 1:p + 1 + k], 2)
+        p += 1 + k
+        if x >= n or v >= n:
+            break
+        elif x > v:
+            v = x
+        elif (x, v) not in seen:
+            seen.add((x, v))
+            neighbors[v].append(x)
+            if x != v:
+                neighbors[x].append(v)
+    return from_neighbors(neighbors)
+
+
+def read_compact(line: "str") -> Graph:
+    if line.startswith(">>sparse6<<") or line.startswith(":"):
+        return read_sparse6(line)
+    return read_graph6(line)
+
+
+def read_compact_list(f: IO[str]):
+    """
+    Yields the graphs of a graph6 or sparse6 file, one per line
+    """
+    for line in f:
+        line = line.strip()
+        if line:
+            yield read_compact(line)
+
+
+def check_unlabeled(graph: Graph):
+    if graph.is_labeled:
+        raise ValueError(
+            "graph6 and sparse6 cannot represent labels or weights")
+
+
+def write_graph6(graph: Graph) -> str:
+    """
+    Returns the graph6 line of graph, which cannot have loops
+    """
+    check_unlabeled(graph)
+    n = graph.size
+    data = bytearray((n * (n - 1) // 2 + 5) // 6)
+    for j, nb in enumerate(graph.neighbors):
+        for i in nb:
+            if i == j:
+                raise ValueError("graph6 cannot represent loops, use sparse6")
+            if i < j:
+                p = j * (j - 1) // 2 + i
+                data[p // 6] |= 1 << 5 - p % 6
+    return encode_size(n) + data.translate(OFFSET_63).decode()
+
+
+def write_sparse6(graph: Graph) -> str:
+    """
+    Returns the sparse6 line of graph
+    """
+    check_unlabeled(graph)
+    n = graph.size
+    k = sparse6_width(n)
+    width = "0{}b".format(k)
+    edges = sorted((max(i, j), min(i, j)) for i, nb in enumerate(graph.neighbors)
+                   for j in nb if j <= i)
+    bits = list()
+    v = 0
+    for w, u in edges:
+        if w == v:
+            bits.append("0" + format(u, width))
+        elif w == v + 1:
+            v = w
+            bits.append("1" + format(u, width))
+        else:
+            v = w
+            bits.append("1" + format(w, width) + "0" + format(u, width))
+    bits = "".join(bits)
+    padding = -len(bits) % 6
+    # With v at n - 2, padding with k + 1 ones reads as the loop at n - 1,
+    # so the spec inserts a 0 first
+    if k < 6 and n == 1 << k and v == n - 2 and padding >= k + 1:
+        bits += "0"
+        padding = -len(bits) % 6
+    return ":" + encode_size(n) + from_bits(bits + "1" * padding)
+
+
+def write_compact_list(graphs: "Iterable[Graph]",
+                       f: IO[str],
+                       sparse: "bool" = False):
+    write = write_sparse6 if sparse else write_graph6
+    for graph in graphs:
+        f.write(write(graph) + "\n")
+
+
+def is_compact(line: "str") -> bool:
+    """
+    Whether line starts a graph6 or sparse6 file, whose characters all lie
+    in ? ... ~ after the optional >>graph6<< or >>sparse6<< header, unlike
+    the numbers of the edge list format
+    """
+    line = line.strip().removeprefix(">>graph6<<").removeprefix(">>sparse6<<")
+    return re.fullmatch(r":?[?-~]+", line) is not None
+
+
+def load_graph_list(f: IO[str], jobs: "int" = None) -> List[Graph]:
+    """
+    Reads all graphs of an edge list, graph6 or sparse6 file, with jobs > 1
+    in that many processes
+    """
+    if f.seekable():
+        first = read_line(f)
+        f.seek(0)
+        if is_compact(first):
+            if jobs is not None and jobs > 1:
+                lines = [line.strip() for line in f if line.strip()]
+                return parse_parallel(read_compact, lines, jobs)
+            return list(read_compact_list(f))
+    return read_graph_list(f, jobs)
+
+
+# Magic bytes of the compressed formats and the functions opening them
+COMPRESSED = {
+    b"\x1f\x8b": gzip.open,
+    b"\xfd7zXZ\x00": lzma.open,
+}
+
+
+def open_graph_file(path: "str") -> IO[str]:
+    """
+    Opens path for reading as text, decompressing gzip and xz files
+    """
+    with open(path, "rb") as f:
+        magic = f.read(6)
+    for prefix, opener in COMPRESSED.items():
+        if magic.startswith(prefix):
+            return opener(path, "rt")
+    return open(path)
+
+
+def load_graph_file(path: "str", jobs: "int" = None) -> List[Graph]:
+    """
+    Reads all graphs of the possibly compressed file path
+    """
+    with open_graph_file(path) as f:
+        return load_graph_list(f, jobs)
+
+
+def write_graph(graph: Graph, f: IO[str]):
+    """
+    Writes graph as one block of an edge list file, with its edge weights
+    and vertex labels
+    """
+    lines = ["# Number of vertices:", str(graph.size), "# Edge list:"]
+    for i, nb in enumerate(graph.neighbors):
+        for j in nb:
+            if j <= i:
+                w = graph.weight(i, j)
+                lines.append("{},{}".format(i, j) if w is None else
+                             "{},{}:{}".format(i, j, w))
+    if graph.labels is not None:
+        lines.extend("{}:{}".format(i, label)
+                     for i, label in enumerate(graph.labels)
+                     if label is not None)
+    f.write("\n".join(lines) + "\n")
+
+
+def write_graph_list(graphs: "Iterable[Graph]", f: IO[str]):
+    for k, graph in enumerate(graphs):
+        if k:
+            f.write("--- Next graph:\n")
+        write_graph(graph, f)
 
 
 def write_dot(graph: Graph, f: IO[str]):
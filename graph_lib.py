@@ -1,16 +1,83 @@
 from math import factorial
+from time import monotonic
+from hashlib import sha256
+from collections import Counter
+from weakref import WeakKeyDictionary
 from graph_adj import *
 from basicpermutationgroup import *
 
+# Result of is_iso and count_aut when the search ran out of budget
+UNDECIDED = None
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+class Budget:
+    """
+    Deadline (in seconds from creation) and maximum number of search nodes
+    for a single is_iso or count_aut call. Either limit may be None. A
+    search running in another process is stopped early by setting the
+    multiprocessing event cancel.
+    """
+
+    def __init__(self,
+                 timeout: "float" = None,
+                 max_nodes: "int" = None,
+                 cancel: "Event" = None):
+        self.deadline = None if timeout is None else monotonic() + timeout
+        self.max_nodes = max_nodes
+        self.cancel = cancel
+        self.nodes = 0
+
+    def spend(self):
+        """
+        Accounts for one search node, raises BudgetExceeded if a limit is hit
+        """
+        self.nodes += 1
+        if self.max_nodes is not None and self.nodes > self.max_nodes:
+            raise BudgetExceeded()
+        if self.deadline is not None and monotonic() > self.deadline:
+            raise BudgetExceeded()
+        if self.cancel is not None and self.cancel.is_set():
+            raise BudgetExceeded()
+
+    def remaining(self):
+        """
+        Returns the time and number of nodes left, for handing the rest of
+        the budget to other processes
+        """
+        timeout = None
+        if self.deadline is not None:
+            timeout = max(0, self.deadline - monotonic())
+        max_nodes = None
+        if self.max_nodes is not None:
+            max_nodes = max(0, self.max_nodes - self.nodes)
+        return timeout, max_nodes
+
 
 def is_unbalanced(A, B):
-    return not sorted(A.colors) == sorted(B.colors)
+    return Counter(A.colors) != Counter(B.colors)
 
 
 def is_bijective(A, B):
-    a = sorted(A.colors)
-    b = sorted(B.colors)
-    return a == b and len(set(a)) == A.size and len(set(b)) == B.size
+    """
+    Whether every color occurs exactly once on either side, for A and B
+    with balanced colorings
+    """
+    return len(set(A.colors)) == A.size
+
+
+def leaf_mapping(U: "DisjointUnion") -> List[int]:
+    """
+    Returns the bijection of a discrete coloring of the union of two
+    graphs: every vertex of the first one is mapped to the vertex of the
+    second one with the same color
+    """
+    n = U.size
+    image = {c: k for k, c in enumerate(U.colors[n:])}
+    return [image[c] for c in U.colors[:n]]
 
 
 def colour_twins(A: "Graph", B: "Graph"):
@@ -33,21 +100,22 @@ def colour_twins(A: "Graph", B: "Graph"):
 
 
 def membership_test(H: "list", f: "permutation"):
-    alpha = FindNonTrivialOrbit(H)
-    if alpha is None:
-        return False
-    if f.istrivial():
-        return True
-    orbit, transversal = Orbit(H, alpha, True)
-    beta = f.__getitem__(alpha)
-    u = [v for v in transversal if v.__getitem__(alpha) == beta]
-    if not u:
-        return False
-    u = u[0]
-    if u.istrivial():
-        return False
-    else:
-        return membership_test(Stabilizer(H, alpha), -u * f)
+    while True:
+        alpha = FindNonTrivialOrbit(H)
+        if alpha is None:
+            return False
+        if f.istrivial():
+            return True
+        orbit, transversal = Orbit(H, alpha, True)
+        beta = f.__getitem__(alpha)
+        u = [v for v in transversal if v.__getitem__(alpha) == beta]
+        if not u:
+            return False
+        u = u[0]
+        if u.istrivial():
+            return False
+        # Continue in the stabilizer of alpha
+        H, f = Stabilizer(H, alpha), -u * f
 
 
 def cardinality_generating_set(H: "list"):
@@ -57,13 +125,14 @@ def cardinality_generating_set(H: "list"):
     :param H: the generating set
     """
 
+    cardinality = 1
     alpha = FindNonTrivialOrbit(H)
-    if alpha is not None:
-        length_orbit = Orbit(H, alpha, False).__len__()
-        stab = Stabilizer(H, alpha)
-        return length_orbit * cardinality_generating_set(stab)
-    else:
-        return 1
+    # Walk down the stabilizer chain
+    while alpha is not None:
+        cardinality *= Orbit(H, alpha, False).__len__()
+        H = Stabilizer(H, alpha)
+        alpha = FindNonTrivialOrbit(H)
+    return cardinality
 
 
 def construct_genset(H: "list", f):
@@ -72,138 +141,146 @@ def construct_genset(H: "list", f):
     return H
 
 
-def cycles_from_mapping(mapping: "List"):
-    cycles = list()
-    # This creates a cycle representation of the mapping
-    for c in [[c[0], c[1]] for c in mapping if c[0] != c[1]]:
-        if not cycles:
-            cycles.append(c)
-            continue
-        append = [x for x in cycles if x[-1] == c[0]]
-        prepend = [x for x in cycles if x[0] == c[-1]]
-
-        if append and prepend:
-            append = append[0]
-            prepend = prepend[0]
-            if append == prepend:
-                i = cycles.index(append)
-                cycles[i] = append[:-1] + c[:-1]
-            else:
-                i = cycles.index(append)
-                cycles[i] = append[:-1] + c[:-1] + prepend
-                cycles.remove(prepend)
-        elif append:
-            append = append[0]
-            i = cycles.index(append)
-            cycles[i] = append[:-1] + c
-            if cycles[i][0] == cycles[i][-1]:
-                cycles[i] = cycles[i][:-1]
-        elif prepend:
-            prepend = prepend[0]
-            j = cycles.index(prepend)
-            cycles[j] = c[:-1] + prepend
-            if cycles[j][0] == cycles[j][-1]:
-                cycles[j] = cycles[j][:-1]
-        else:
-            cycles.append(c)
-    return cycles
+def is_isomorphism(A: "Graph", B: "Graph", mapping: "List[int]") -> bool:
+    """
+    Tests in O(n + m) whether vertex v of A to vertex mapping[v] of B is an
+    isomorphism that keeps labels and weights. Any list is accepted as
+    mapping, so results from elsewhere can be verified.
+    """
+    if A.size != B.size or A.num_edges != B.num_edges:
+        return False
+    if len(mapping) != A.size or set(mapping) != set(range(A.size)):
+        return False
+    weighted = A.is_weighted or B.is_weighted
+    for v, nb in enumerate(A.neighbors):
+        if {mapping[w] for w in nb} != set(B.neighbors[mapping[v]]):
+            return False
+        if A.label(v) != B.label(mapping[v]):
+            return False
+        if weighted and any(
+                A.weight(v, w) != B.weight(mapping[v], mapping[w])
+                for w in nb):
+            return False
+    return True
 
 
-def AHU(X: "Graph", centerx: "Vertex", Y: "Graph", centery: "Vertex"):
-    if X.size == 1 and Y.size == 1:
-        return True
-    if X.size != Y.size:
-        return False
+def rooted_tree_hash(G: "Graph", root: "Vertex") -> bytes:
+    """
+    Canonical hash of G rooted at root: every vertex is hashed from the
+    sorted hashes of its children, so isomorphic rooted trees get equal
+    hashes
+    """
+    _, parent, d = G.graph_search(root)
+    children = {v: [] for v in d}
+    hashes = {}
+    # Deepest vertices first, so all children are hashed before the parent
+    for v in sorted(d, key=d.get, reverse=True):
+        hashes[v] = sha256(b"(" + b"".join(sorted(children[v])) +
+                           b")").digest()
+        if parent[v] != -1:
+            children[parent[v]].append(hashes[v])
+    return hashes[root.i]
 
-    _, _, dx = X.graph_search(centerx)
-    _, _, dy = Y.graph_search(centery)
-    # dictionary with key = level, value = list of vertices corresponding to that level
-    level_vertsX = {}
-    level_vertsY = {}
-    labelx = {}  # canonical representation of a vertex
-    labely = {}
-    canonx = {}  # canonical representation of level
-    canony = {}
-
-    max_levelX = max(dx.values())  # depth of the tree
-    max_levelY = max(dy.values())
-
-    for lx, ly in zip(range(0, max_levelX + 1), range(0, max_levelY + 1)):
-        # gather all vertices at particular level lx
-        z1 = [v for v in dx.keys() if dx[v] == lx]
-        z2 = [v for v in dy.keys() if dy[v] == ly]
-        level_vertsX[lx] = z1
-        level_vertsY[ly] = z2
-
-    # if the trees have different depths then obviously no isomorphism
-    if max_levelX != max_levelY:
-        return False
 
-    # leaves: all vertices with degree 1 (no children themselves)
-    leavesx = [v.i for v in X.vertices if v.degree == 1]
-    leavesy = [v.i for v in Y.vertices if v.degree == 1]
-    if len(leavesy) != len(leavesx):
-        return False
-    for vx, vy in zip(leavesx, leavesy):  # all leaves get label 1
-        labelx[vx] = 0
-        labely[vy] = 0
-
-    for lx, ly in zip(range(max_levelX, -1, -1),
-                      range(max_levelY, -1, -1)):
-        # if the cardinality of the levels differ -> no isomorphism
-        if len(level_vertsX[lx]) != len(level_vertsY[ly]):
-            return False
-        for vx, vy in zip(level_vertsX[lx], level_vertsY[ly]):
-            # iterate over the children of particular vertex vx/vy in layer lx/ly
-            vx = Vertex(X, vx)
-            vy = Vertex(Y, vy)
-            if vx.degree > 1:
-                # if vx.degree == 1 -> leave -> already a label -> skip labeling
-                # list of the labels of the children
-                labelx[vx.i] = int("".join(
-                    map(
-                        str,
-                        sorted([
-                            labelx[c] for c in level_vertsX[lx + 1]
-                            if vx.is_adjacent(Vertex(X, c))
-                        ]))))
-            if vy.degree > 1:
-                # list of the labels of the children
-                labely[vy.i] = int("".join(
-                    map(
-                        str,
-                        sorted([
-                            labely[c] for c in level_vertsY[ly + 1]
-                            if vy.is_adjacent(Vertex(Y, c))
-                        ]))))
-
-        # canonical representation for the layer
-        canonx[lx] = [labelx[v] for v in level_vertsX[lx]]
-        # canonical representation for the layer
-        canony[ly] = [labely[v] for v in level_vertsY[ly]]
-
-        if sorted(canonx[lx]) == sorted(canony[ly]):
-            # Convert list
-            mapping = dict()
-
-            old_labelx = labelx.copy()
-            old_labely = labely.copy()
-            next_label = 1
-            for vx, vy in zip(level_vertsX[lx], level_vertsY[ly]):
-                if old_labelx[vx] not in mapping:
-                    mapping[old_labelx[vx]] = next_label
-                    next_label += 1
-
-                if old_labely[vy] not in mapping:
-                    mapping[old_labely[vy]] = next_label
-                    next_label += 1
-
-                labelx[vx] = mapping[old_labelx[vx]]
-                labely[vy] = mapping[old_labely[vy]]
+def tree_certificate(G: "Graph") -> str:
+    """
+    Canonical certificate of the tree G, equal for isomorphic trees
+    """
+    return min(rooted_tree_hash(G, c) for c in G.find_center()).hex()
+
+
+class SubtreeCodes:
+    """
+    Per-run table of rooted subtree shapes. A shape is coded by the sorted
+    ids of the shapes of its children and interned to an id, so every
+    distinct shape, and its number of automorphisms, is computed only once
+    for all trees that use the same table.
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.aut = []
+        self._certificates = WeakKeyDictionary()
+
+    def intern(self, code: "tuple") -> int:
+        if code not in self.ids:
+            count = 1
+            for c, m in Counter(code).items():
+                count *= factorial(m) * pow(self.aut[c], m)
+            self.ids[code] = len(self.aut)
+            self.aut.append(count)
+        return self.ids[code]
+
+    def rooted(self, G: "Graph", root: "Vertex", budget: "Budget" = None):
+        """
+        Returns the id of the shape of G rooted at root
+        """
+        return self.vertex_codes(G, root, budget)[0][root.i]
+
+    def vertex_codes(self,
+                     G: "Graph",
+                     root: "Vertex",
+                     budget: "Budget" = None):
+        """
+        Returns the id of the shape of the subtree below every vertex of G
+        rooted at root, and the parent of every vertex
+        """
+        _, parent, d = G.graph_search(root)
+        children = {v: [] for v in d}
+        ids = {}
+        # Deepest vertices first, so all children are coded before the parent
+        for v in sorted(d, key=d.get, reverse=True):
+            if budget:
+                budget.spend()
+            ids[v] = self.intern(tuple(sorted(children[v])))
+            if parent[v] != -1:
+                children[parent[v]].append(ids[v])
+        return ids, parent
+
+    def isomorphism(self, X: "Graph", Y: "Graph") -> List[int]:
+        """
+        Returns a mapping of the vertices of the tree X to the vertices of
+        the tree Y, or None if they are not isomorphic. Starting from
+        centers of the same shape, the children of mapped vertices are
+        matched by shape from the top down (AHU).
+        """
+        x = X.find_center()[0]
+        ids_x, parent_x = self.vertex_codes(X, x)
+        for y in Y.find_center():
+            ids_y, parent_y = self.vertex_codes(Y, y)
+            if ids_y[y.i] == ids_x[x.i]:
+                break
         else:
-            return False
+            return None
 
-    if labelx[centerx.i] == labely[centery.i]:
-        return True
-    else:
-        return False
+        mapping = [None] * X.size
+        stack = [(x.i, y.i)]
+        while stack:
+            v, w = stack.pop()
+            mapping[v] = w
+            cv = sorted((ids_x[c], c) for c in X.neighbors[v]
+                        if c != parent_x[v])
+            cw = sorted((ids_y[c], c) for c in Y.neighbors[w]
+                        if c != parent_y[w])
+            stack.extend((a, b) for (_, a), (_, b) in zip(cv, cw))
+        return mapping
+
+    def certificate(self, G: "Graph", budget: "Budget" = None) -> tuple:
+        """
+        Returns the sorted ids of G rooted at each of its centers, equal
+        for isomorphic trees that use this table
+        """
+        if G not in self._certificates:
+            self._certificates[G] = tuple(
+                sorted(self.rooted(G, c, budget) for c in G.find_center()))
+        return self._certificates[G]
+
+    def count_aut(self, G: "Graph", budget: "Budget" = None) -> int:
+        """
+        Returns the number of automorphisms of the tree G
+        """
+        cert = self.certificate(G, budget)
+        # With two centers that have the same shape they can be swapped
+        if len(cert) == 2 and cert[0] == cert[1]:
+            return 2 * self.aut[cert[0]]
+        return self.aut[cert[0]]
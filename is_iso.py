@@ -1,92 +1,272 @@
 from graph_adj import *
-from collections import Counter
-from fast_col_ref import color_refinement
+from fast_col_ref import color_refinement, pair_refinement
 from graph_lib import *
+from cell_selection import STRATEGIES, DEFAULT_STRATEGY, cells_of, choose_strategy
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import Event
 
 
-def is_isomorph(X: "Graph", Y: "Graph", firstcall: "bool" = True):
-    # If the number of vertices or edges is different they cannot be
-    # isomorphic
+def individualize(colors: "List", v: "int", candidates: "List",
+                  new_color: "int"):
+    """
+    Search frame for a single node: yields the coloring of every child node,
+    in which v and one of the candidates receive the same new color, and the
+    new color as splitter for the refinement
+    """
+    for u in candidates:
+        child = colors.copy()
+        child[v] = new_color
+        child[u] = new_color
+        yield child, [new_color]
 
-    # Create disjoint union
-    U = X + Y
-    # Apply color refinement
-    color_refinement(U, reset_colors=False)
-    # Split the union up again
-    A, B = U.split_disjoint()
-    #if firstcall:
-    #    colour_twins(A, B)
 
-    # Check for unbalancy and bijectivity for early recursion exit
-    if is_unbalanced(A, B):
+def expand(U: "DisjointUnion", A: "UnionSide", B: "UnionSide", colors: "List",
+           splitters: "List", select, wl2: "bool"):
+    """
+    Refines the search node with the given colors. Returns True for a
+    bijective leaf, False for an unbalanced node and otherwise the frame of
+    its children. Near the root (wl2) 2-WL is used where color refinement
+    does not split any cell.
+    """
+    U.colors = colors
+    if wl2:
+        cells = len(set(colors))
+    # Refinement gives up as soon as a color is out of balance
+    if not color_refinement(
+            U, reset_colors=False, splitters=splitters, sides=A.size):
         return False
-    elif is_bijective(A, B):
-        return True
+    if wl2 and len(set(U.colors)) == cells:
+        pair_refinement(U)
+        if is_unbalanced(A, B):
+            return False
 
-    # Get all color classes with size >= 2 in both graphs
-    color_classes = [{
-        "color": c,
-        "n": n,
-        "degree": A.degree_of_color(c)
-    } for c, n in Counter([v.color for v in A.vertices]).items() if n >= 2]
-
-    ##################################
-    #### Selection of color class ####
-    ##################################
-    # Select color by number of vertices
-    ref_c_class = max(color_classes, key=lambda c: c["n"])
+    # Check for bijectivity for early exit
+    if is_bijective(A, B):
+        return True
 
-    # Select color by number of vertices and degree
-    # ref_c_class = max(color_classes, key=lambda c: (c["n"], c["degree"]))
+    # Select the target cell among the color classes with size >= 2
+    ref_c = select(A, cells_of(A))
 
-    # Select first color
-    # ref_c_class = color_classes[0]
+    # Choose the first vertice of that color
+    v = A.colors.index(ref_c)
 
-    # Select color by degree
-    # ref_c_class = min(color_classes, key=lambda c: c["degree"])
+    # Try every vertex of B with that color as its image
+    candidates = [k + U.size for k, c in enumerate(B.colors) if c == ref_c]
+    return individualize(U.colors, v, candidates, A.max_color + 1)
 
-    # All vertices in A of that color
-    ref_c = ref_c_class["color"]
-    color_vertices = [v for v in A.vertices if v.color == ref_c]
 
-    # Choose a vertice
-    v = color_vertices[0]
+def is_isomorph(X: "Graph",
+                Y: "Graph",
+                budget: "Budget" = None,
+                strategy: "str" = DEFAULT_STRATEGY,
+                wl2_depth: "int" = 0,
+                root: "tuple" = None,
+                root_depth: "int" = 0,
+                mapping: "List" = None):
+    """
+    Searches for an isomorphism below root, a (colors, splitters) node of
+    the disjoint union of X and Y at depth root_depth, by default the
+    coloring of the union itself. The isomorphism found is appended to
+    mapping.
+    """
+    select = STRATEGIES[choose_strategy(X, strategy)]
 
-    # Create a new color for it
-    v.change_color(A.max_color + 1)
+    # Create disjoint union, the search nodes only differ in their colors
+    U = X + Y
+    # Views on both sides of the union, they follow U.colors
+    A, B = U.split_disjoint()
+    # Explicit stack of search frames instead of recursion
+    stack = [iter([root or (U.colors, None)])]
+    while stack:
+        node = next(stack[-1], None)
+        if node is None:
+            stack.pop()
+            continue
+        if budget:
+            budget.spend()
 
-    num = 0
-    for u in [k for k in B.vertices if k.color == ref_c]:
-        old_u_color = u.color
-        u.change_color(v.color)
-        if is_isomorph(A, B, False):
+        children = expand(U, A, B, *node, select,
+                          root_depth + len(stack) <= wl2_depth)
+        if children is True:
+            if mapping is not None:
+                mapping.extend(leaf_mapping(U))
             return True
-        u.change_color(old_u_color)
+        elif children:
+            stack.append(children)
     return False
 
 
-def tree_isomorphism(X: "Graph", centerx, Y: "Graph", centery):
-    if len(centerx) == 1 and len(centery) == 1:
-        return AHU(X, centerx[0], Y, centery[0])
-    elif len(centerx) == 2 and len(centery) == 2:
-        return AHU(X, centerx[0], Y, centery[0]) or AHU(
-            X, centerx[1], Y, centery[0])
-    else:
-        return False
+def branch_roots(X: "Graph",
+                 Y: "Graph",
+                 depth: "int",
+                 budget: "Budget" = None,
+                 strategy: "str" = DEFAULT_STRATEGY,
+                 wl2_depth: "int" = 0,
+                 mapping: "List" = None):
+    """
+    Expands the search tree of X and Y breadth first down to depth and
+    returns the remaining nodes there, or True if a bijective leaf was
+    found on the way, whose isomorphism is appended to mapping
+    """
+    select = STRATEGIES[choose_strategy(X, strategy)]
+    U = X + Y
+    A, B = U.split_disjoint()
+    level = [(U.colors, None)]
+    for d in range(depth):
+        next_level = list()
+        for node in level:
+            if budget:
+                budget.spend()
+            children = expand(U, A, B, *node, select, d < wl2_depth)
+            if children is True:
+                if mapping is not None:
+                    mapping.extend(leaf_mapping(U))
+                return True
+            elif children:
+                next_level.extend(children)
+        level = next_level
+    return level
 
 
-def is_iso(A: "Graph", B: "Graph") -> bool:
-    a_tree = A.is_tree()
-    b_tree = B.is_tree()
+# Graphs and cancel event of the parallel search, set in every worker
+_branch_search = None
+
+
+def init_branch_worker(X: "Graph", Y: "Graph", cancel: "Event"):
+    global _branch_search
+    _branch_search = (X, Y, cancel)
+
+
+def explore_branch(root: "tuple", depth: "int", timeout: "float",
+                   max_nodes: "int", strategy: "str", wl2_depth: "int"):
+    """
+    Worker task: searches the subtree below root, returns the result, the
+    isomorphism found and the number of nodes visited
+    """
+    X, Y, cancel = _branch_search
+    budget = Budget(timeout, max_nodes, cancel)
+    mapping = list()
+    try:
+        result = is_isomorph(X,
+                             Y,
+                             budget=budget,
+                             strategy=strategy,
+                             wl2_depth=wl2_depth,
+                             root=root,
+                             root_depth=depth,
+                             mapping=mapping)
+    except BudgetExceeded:
+        result = UNDECIDED
+    return result, mapping, budget.nodes
+
+
+def parallel_isomorph(X: "Graph",
+                      Y: "Graph",
+                      jobs: "int",
+                      depth: "int" = 1,
+                      budget: "Budget" = None,
+                      strategy: "str" = DEFAULT_STRATEGY,
+                      wl2_depth: "int" = 0,
+                      mapping: "List" = None):
+    """
+    is_isomorph with the subtrees below depth explored by jobs processes.
+    The first isomorphism found, and verified, cancels all other branches,
+    X and Y are only non isomorphic once every branch has finished. Each
+    branch may use the rest of the budget, its nodes are added to budget.
+    """
+    roots = branch_roots(X, Y, depth, budget, strategy, wl2_depth, mapping)
+    if roots is True or not roots:
+        return bool(roots)
+    timeout, max_nodes = budget.remaining() if budget else (None, None)
+
+    # Strategy "auto" is resolved once here for all branches
+    strategy = choose_strategy(X, strategy)
+    cancel = Event()
+    result = False
+    with ProcessPoolExecutor(jobs,
+                             initializer=init_branch_worker,
+                             initargs=(X, Y, cancel)) as pool:
+        futures = [
+            pool.submit(explore_branch, root, depth, timeout, max_nodes,
+                        strategy, wl2_depth) for root in roots
+        ]
+        for future in as_completed(futures):
+            found, found_mapping, nodes = future.result()
+            if budget:
+                budget.nodes += nodes
+            if found and is_isomorphism(X, Y, found_mapping):
+                if mapping is not None:
+                    mapping.extend(found_mapping)
+                result = True
+                cancel.set()
+                for f in futures:
+                    f.cancel()
+                break
+            elif found is UNDECIDED:
+                result = UNDECIDED
+    if result is UNDECIDED:
+        raise BudgetExceeded()
+    return result
+
+
+def is_iso(A: "Graph",
+           B: "Graph",
+           budget: "Budget" = None,
+           strategy: "str" = DEFAULT_STRATEGY,
+           codes: "SubtreeCodes" = None,
+           wl2_depth: "int" = 0,
+           parallel: "int" = None,
+           parallel_depth: "int" = 1,
+           mapping: "List" = None) -> bool:
+    """
+    Returns whether A and B are isomorphic, or UNDECIDED if the budget
+    ran out before the search finished. strategy names the target cell
+    selection of the search, see cell_selection.STRATEGIES, or is "auto".
+    Trees are compared through codes, which can be shared between calls,
+    unless they have vertex labels or edge weights.
+    Search nodes up to depth wl2_depth - 1 where color refinement makes no
+    progress are refined with 2-WL as well. With parallel > 1 the subtrees
+    below parallel_depth are searched by that many processes.
+    If A and B are isomorphic an isomorphism is appended to mapping, vertex
+    v of A maps to vertex mapping[v] of B, see graph_lib.is_isomorphism.
+    """
+    if A.is_weighted != B.is_weighted:
+        return False
+    a_tree = A.is_tree() and not A.is_labeled
+    b_tree = B.is_tree() and not B.is_labeled
     if a_tree and b_tree:
-        return tree_isomorphism(A, A.find_center(), B, B.find_center())
+        if codes is None:
+            codes = SubtreeCodes()
+        if codes.certificate(A) != codes.certificate(B):
+            return False
+        if mapping is not None:
+            mapping.extend(codes.isomorphism(A, B))
+        return True
     elif a_tree and not b_tree or not a_tree and b_tree:
         return False
     elif A.size != B.size or sum([len(n) for n in A.neighbors]) != sum(
         [len(n) for n in B.neighbors]):
         return False
     else:
-        return is_isomorph(A, B)
+        # Equal numbers of edges, so both or neither are complemented
+        try:
+            if parallel and parallel > 1:
+                return parallel_isomorph(sparser(A),
+                                         sparser(B),
+                                         parallel,
+                                         parallel_depth,
+                                         budget=budget,
+                                         strategy=strategy,
+                                         wl2_depth=wl2_depth,
+                                         mapping=mapping)
+            return is_isomorph(sparser(A),
+                               sparser(B),
+                               budget=budget,
+                               strategy=strategy,
+                               wl2_depth=wl2_depth,
+                               mapping=mapping)
+        except BudgetExceeded:
+            return UNDECIDED
 
 
 if __name__ == "__main__":
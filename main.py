@@ -1,11 +1,22 @@
 #!/bin/python
-from is_iso import is_iso
-from count_aut import count_aut
-from graph_io_adj import load_graph_list
-from graph_lib import cycles_from_mapping
+from classify import Classifier, IsoClasses
+from graph_io_adj import load_graph_file
+from graph_lib import UNDECIDED, SubtreeCodes
+from cell_selection import STRATEGIES, DEFAULT_STRATEGY
+from result_cache import ResultCache
+from shard import Coordinator, work, parse_address, new_authkey
+from class_index import ClassIndex, IndexClient, serve_index
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import itertools as it
 import sys
 import argparse
+import os
+import asyncio
+import glob
+import json
+
+# Subtree shapes seen in this run, shared by all tree tests and counts
+codes = SubtreeCodes()
 
 
 def print_help():
@@ -19,108 +30,343 @@ def print_help():
     print("{-af}     Calculate automorphs first and the compare the")
     print("          ones with equal amount for isomorphism.")
     print("{-v}      Enable verbose mode for more logs.")
+    print("{--timeout}   Seconds a single isomorphism test or automorphism")
+    print("              count may take before it is reported undecided.")
+    print("{--max-nodes} Search nodes a single test or count may visit.")
+    print("{-b}          Refine all graphs together once and only test")
+    print("              graphs with equal color histograms.")
+    print("{--wl2}       Search depth up to which 2-WL refinement is used")
+    print("              where color refinement splits nothing.")
+    print("{--cache}     SQLite file in which results are stored and looked")
+    print("              up across runs.")
+    print("{--cell}      Target cell selection of the search, one of")
+    print("              {} or auto.".format(", ".join(STRATEGIES)))
+    print("{--json}      Process all files concurrently and print every")
+    print("              result as a JSON line as soon as it is known.")
+    print("{--cross}     With --json, also print the isomorphism classes")
+    print("              across all files.")
+    print("{--jobs}      Number of worker processes for --json.")
+    print("{--parse-jobs} Number of processes that parse the graphs of a")
+    print("              file. Files may be gzip or xz compressed.")
+    print("{--parallel}  Number of processes that search the branches of a")
+    print("              single isomorphism test or automorphism count.")
+    print("{--parallel-depth} Search depth at which the branches are handed")
+    print("              to the --parallel processes, 1 by default.")
+    print("{--serve}     Coordinate workers at host:port or a Unix socket")
+    print("              path, which classify the graphs of all files in")
+    print("              shards, and print JSON lines as with --json.")
+    print("{--worker}    Work for the coordinator at host:port or socket path,")
+    print("              no files are needed.")
+    print("{--authkey}   Shared secret of coordinator and workers, or of")
+    print("              the daemon and its clients. Required by --worker and")
+    print("              --ask, --serve and --daemon print a random one if")
+    print("              none is given.")
+    print("{--daemon}    Index the graphs of all files and answer --ask")
+    print("              requests at host:port or a Unix socket path.")
+    print("{--ask}       Look up the class of every graph of the files in the")
+    print("              daemon at this address, with -a also its number of")
+    print("              automorphisms.")
+    print("{--add}       With --ask, add the graphs to the index.")
+    print("{--stop}      With --ask, stop the daemon afterwards.")
+
+
+def make_classifier(args, cache=None):
+    return Classifier(timeout=args.timeout,
+                      max_nodes=args.max_nodes,
+                      cell=args.cell,
+                      wl2=args.wl2,
+                      batch=args.batch,
+                      cache=cache,
+                      codes=codes,
+                      verbose=args.verbose,
+                      parallel=args.parallel,
+                      parallel_depth=args.parallel_depth)
+
+
+def format_count(count):
+    return "undecided" if count is UNDECIDED else count
+
+
+def load(path, jobs=None):
+    return load_graph_file(path, jobs)
 
 
-def equivalence_classes(args, graph_list=None):
-    with open(args.path) as f:
-        G = load_graph_list(f)
+def selected(args, G):
+    """
+    Returns the indices of the graphs of G selected by --graph, indices
+    past the end of the file are ignored
+    """
+    if args.graph:
+        return sorted(i for i in set(args.graph) if 0 <= i < len(G))
+    return range(len(G))
 
-    if graph_list == None:
-        graph_list = args.graph
 
-    if graph_list:
-        G = [g for i, g in enumerate(G) if i in graph_list]
+def open_cache(args):
+    return ResultCache(args.cache) if args.cache else None
 
-    if graph_list:
-        zipper = sorted(graph_list)
+
+def for_file(args, path):
+    """
+    Returns a copy of args for the single file path
+    """
+    return argparse.Namespace(**dict(vars(args), path=path))
+
+
+def report(args, cache=None):
+    """
+    Prints the classes and/or automorphism counts of the file args.path
+    """
+    both = args.iso and args.aut or not args.iso and not args.aut
+    G = load(args.path, args.parse_jobs)
+    result = make_classifier(args, cache).classify(
+        G,
+        "aut_first" if args.autfirst else "iso_first",
+        selected(args, G),
+        iso=both or args.iso,
+        aut=both or args.aut)
+
+    if both:
+        for c in result.classes:
+            print("{} {}".format(c, format_count(result.counts[c[0]])))
+    elif args.aut:
+        for k, v in sorted(result.counts.items()):
+            print("[{}] {}".format(k, format_count(v)))
     else:
-        zipper = range(len(G))
+        for c in result.classes:
+            print(c)
+    for p in result.undecided:
+        print("undecided pair {} {}".format(*p))
 
-    if args.verbose:
-        print("Calculating equivalence classes for graphs", list(zipper))
 
-    pairs = list()
-    passed = set()
-    non_iso = {i: set() for i in zipper}
+def aut_records(args, path, graphs):
+    """
+    Worker task: the automorphism counts of graphs, a dict index -> Graph
+    of graphs of path
+    """
+    cache = open_cache(args)
+    result = make_classifier(args, cache).automorphs(graphs, sorted(graphs))
+    if cache:
+        cache.close()
+    return [{
+        "file": path,
+        "graph": i,
+        "automorphisms": result.counts[i]
+    } for i in sorted(graphs)]
 
-    for (i, a), (j, b) in it.combinations(zip(zipper, G), 2):
-        if i == j or i in passed or j in passed:
-            continue
 
-        if args.verbose:
-            print("Checking for isomorphism between {} and {}".format(i, j))
-        if any(j in sl for sl in pairs):
-            pairs_with_j = [p for p in pairs if j in p]
-            other = set()
-            for p in pairs_with_j:
-                if p[0] != j:
-                    other.add(p[0])
-                else:
-                    other.add(p[1])
-
-            not_iso = False
-            for o in other:
-                if o in non_iso[i]:
-                    if args.verbose:
-                        print(
-                            "{} is isomorphic with {} which is non isomorphic with {} so skipping"
-                            .format(j, o, i))
-                    not_iso = True
-                    break
-            if not_iso:
+def class_records(args, path, G):
+    """
+    Worker task: the isomorphism classes and undecided pairs of the graphs
+    G of path
+    """
+    cache = open_cache(args)
+    result = make_classifier(args, cache).equivalence_classes(
+        G, selected(args, G))
+    if cache:
+        cache.close()
+    return [{"file": path, "class": c} for c in result.classes
+            ] + [{"file": path, "undecided": p} for p in result.undecided]
+
+
+def cross_records(args, file_classes, graphs):
+    """
+    Worker task: merges the classes of all files, given as (path, class)
+    pairs, by testing their first graphs, given in graphs by (path, index),
+    for isomorphism. Classes of the same file are never merged.
+    """
+
+    classes = IsoClasses(
+        (path, i) for path, c in file_classes for i in c)
+    for path, c in file_classes:
+        for i in c[1:]:
+            classes.union((path, c[0]), (path, i))
+    for (p, c), (q, d) in it.combinations(file_classes, 2):
+        if p == q:
+            classes.separate((p, c[0]), (q, d[0]))
+
+    cache = open_cache(args)
+    classifier = make_classifier(args, cache)
+    reps = list()
+    for path, c in file_classes:
+        key = (path, c[0])
+        for r in reps:
+            if classes.is_separated(r, key):
                 continue
-        if is_iso(a, b):
-            if args.verbose:
-                print("{} and {} are isomorphic".format(i, j))
-            pairs.append([i, j])
-            passed.add(i)
-
-            for x in non_iso[j]:
-                non_iso[i].add(x)
-            non_iso[j] = non_iso[i]
-        else:
-            non_iso[i].add(j)
-            non_iso[j].add(i)
-
-    cycles = cycles_from_mapping(pairs)
-    single = set()
-    for i in zipper:
-        found = True
-        for c in cycles:
-            if i in c:
-                found = False
+            iso, _ = classifier.is_iso(graphs[key], graphs[r])
+            if iso:
+                classes.union(r, key)
                 break
-        if found:
-            single.add(i)
-
-    eq_classes = list()
-    for c in cycles:
-        eq_classes.append(sorted(c))
-    for i in single:
-        eq_classes.append([i])
-    return eq_classes
-
-
-def automorphs(args, graph_list=None):
-    if graph_list == None:
-        graph_list = args.graph
-    with open(args.path) as f:
-        G = load_graph_list(f)
-    if graph_list:
-        G = [g for i, g in enumerate(G) if i in graph_list]
-
-    if graph_list:
-        zipper = sorted(graph_list)
-    else:
-        zipper = range(len(G))
+            elif iso is not UNDECIDED:
+                classes.separate(r, key)
+        else:
+            reps.append(key)
+    if cache:
+        cache.close()
+
+    merged = dict()
+    for path, c in file_classes:
+        merged.setdefault(classes.find((path, c[0])), list()).extend(
+            {"file": path, "graph": i} for i in c)
+    return [{"class": c} for c in merged.values()]
+
+
+def emit(records):
+    for r in records:
+        print(json.dumps(r), flush=True)
 
-    automorphs = dict()
-    for i, g in zip(zipper, G):
+
+def file_tasks(loop, pool, args, path, G) -> list:
+    """
+    Submits the work on the parsed graphs G of path to pool: the
+    automorphism counts in chunks of graphs and the classes of the file
+    """
+    do_aut = args.aut or not args.iso
+    do_iso = args.iso or not args.aut or args.cross
+    tasks = list()
+    if do_aut:
+        indices = list(selected(args, G))
+        size = max(1, len(indices) // (4 * (args.jobs or os.cpu_count())))
+        for k in range(0, len(indices), size):
+            chunk = {i: G[i] for i in indices[k:k + size]}
+            tasks.append(
+                loop.run_in_executor(pool, aut_records, args, path, chunk))
+    if do_iso:
+        tasks.append(loop.run_in_executor(pool, class_records, args, path, G))
+    return tasks
+
+
+async def stream(args):
+    """
+    Parses every file once, off the event loop, runs the per graph and per
+    file work on its graphs in a process pool and prints the records of
+    every task as soon as it completes
+    """
+    loop = asyncio.get_running_loop()
+
+    with ProcessPoolExecutor(args.jobs) as pool, ThreadPoolExecutor(
+            1) as parser:
+        # Parse task -> path, the work tasks map to None
+        pending = {
+            loop.run_in_executor(parser, load, path, args.parse_jobs): path
+            for path in args.paths
+        }
+        graphs = dict()
+        file_classes = list()
+        while pending:
+            done, _ = await asyncio.wait(pending,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                path = pending.pop(task)
+                if path is not None:
+                    graphs[path] = task.result()
+                    pending.update((t, None) for t in file_tasks(
+                        loop, pool, args, path, graphs[path]))
+                    continue
+                records = task.result()
+                emit(records)
+                file_classes.extend(
+                    (r["file"], r["class"]) for r in records if "class" in r)
+
+        if args.cross:
+            file_classes.sort(key=lambda fc: args.paths.index(fc[0]))
+            reps = {(p, c[0]): graphs[p][c[0]] for p, c in file_classes}
+            emit(await loop.run_in_executor(pool, cross_records, args,
+                                            file_classes, reps))
+
+
+def serve(args):
+    """
+    Coordinator of the sharded batch mode: prints the records of every
+    shard as soon as a worker returns it
+    """
+    do_aut = args.aut or not args.iso
+    do_iso = args.iso or not args.aut
+    graphs = dict()
+    for path in args.paths:
+        G = load(path, args.parse_jobs)
+        for i in selected(args, G):
+            graphs[path, i] = G[i]
+
+    def graph_ref(key):
+        return {"file": key[0], "graph": key[1]}
+
+    def on_result(classes, counts, undecided):
+        if do_iso:
+            for c in classes:
+                record = {"class": [graph_ref(k) for k in c]}
+                if do_aut:
+                    record["automorphisms"] = counts[c[0]]
+                emit([record])
+        else:
+            emit([
+                dict(graph_ref(k), automorphisms=n)
+                for k, n in sorted(counts.items())
+            ])
+        emit([{"undecided": [graph_ref(k) for k in p]} for p in undecided])
+
+    options = dict(timeout=args.timeout,
+                   max_nodes=args.max_nodes,
+                   cell=args.cell,
+                   wl2=args.wl2,
+                   batch=args.batch)
+    Coordinator(parse_address(args.serve), graphs, options, do_iso, do_aut,
+                listener_authkey(args)).run(on_result)
+
+
+def listener_authkey(args) -> bytes:
+    """
+    Returns the --authkey, or a new random key, which is printed to stderr
+    for the clients
+    """
+    if args.authkey is not None:
+        return args.authkey.encode()
+    authkey = new_authkey()
+    print("Authkey", authkey.decode(), file=sys.stderr, flush=True)
+    return authkey
+
+
+def daemon(args):
+    """
+    Indexes the graphs of all files and serves the index until stopped
+    """
+    index = ClassIndex(make_classifier(args, open_cache(args)))
+    for path in args.paths:
+        index.handle({
+            "op": "load",
+            "path": path,
+            "jobs": args.parse_jobs
+        })
         if args.verbose:
-            print("Calculating automorph for graph [{}]".format(i))
-        automorphs[i] = count_aut(g)
+            print("Indexed", path)
+    serve_index(parse_address(args.daemon), index, listener_authkey(args),
+                args.verbose)
+
 
-    return automorphs
+def ask(args):
+    """
+    Looks up or, with --add, indexes the selected graphs of all files in the
+    running daemon and prints a JSON line per graph
+    """
+    client = IndexClient(parse_address(args.ask), args.authkey.encode())
+    for path in args.paths:
+        G = load(path, args.parse_jobs)
+        for i in selected(args, G):
+            record = {"file": path, "graph": i}
+            if args.add:
+                record.update(client.add(G[i], "{}:{}".format(path, i)))
+            else:
+                record.update(client.find(G[i]))
+            if args.aut:
+                # The class was just looked up, only unknown graphs are
+                # sent again
+                if record.get("class") is not None:
+                    record.update(client.aut_count(c=record["class"]))
+                else:
+                    record.update(client.aut_count(G[i]))
+            emit([record])
+    if args.stop:
+        client.stop()
+    client.close()
 
 
 if __name__ == "__main__":
@@ -138,37 +384,68 @@ if __name__ == "__main__":
                      action="store_true",
                      help="Calculate number of automorphisms")
     parser.add_argument("-v", "--verbose", action="store_true")
-    parser.add_argument("path")
+    parser.add_argument("paths", nargs="*")
     parser.add_argument("-af", "--autfirst", action="store_true")
+    parser.add_argument("-b", "--batch", action="store_true")
+    parser.add_argument("--timeout", type=float)
+    parser.add_argument("--max-nodes", type=int)
+    parser.add_argument("--wl2", type=int, default=0)
+    parser.add_argument("--cache")
+    parser.add_argument("--cell",
+                        choices=list(STRATEGIES) + ["auto"],
+                        default=DEFAULT_STRATEGY)
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument("--cross", action="store_true")
+    parser.add_argument("--jobs", type=int)
+    parser.add_argument("--parse-jobs", type=int)
+    parser.add_argument("--parallel", type=int)
+    parser.add_argument("--parallel-depth", type=int, default=1)
+    parser.add_argument("--serve")
+    parser.add_argument("--worker")
+    parser.add_argument("--authkey")
+    parser.add_argument("--daemon")
+    parser.add_argument("--ask")
+    parser.add_argument("--add", action="store_true")
+    parser.add_argument("--stop", action="store_true")
     try:
         args = parser.parse_args()
     except:
         print_help()
         parser.exit()
 
-    if args.iso and args.aut or not args.iso and not args.aut:
-        # Old version, iso first then aut
-        if not args.autfirst:
-            eq_classes = equivalence_classes(args)
-            automorphs = automorphs(args, [c[0] for c in eq_classes])
-            for c in eq_classes:
-                print("{} {}".format(
-                    c, [v for k, v in automorphs.items() if k in c][0]))
-        # New version, only do iso check on graphs
-        # that have the same number of automorphs
-        else:
-            inv_autom = dict()
-            for k, v in automorphs(args).items():
-                inv_autom[v] = inv_autom.get(v, list())
-                inv_autom[v].append(k)
-            for k, v in inv_autom.items():
-                eq_classes = equivalence_classes(args, v)
-                for c in eq_classes:
-                    print("{} {}".format(c, k))
+    if (args.worker or args.ask) and args.authkey is None:
+        parser.error("--worker and --ask need the --authkey of the "
+                     "coordinator or daemon")
+    if args.worker:
+        cache = open_cache(args)
+        work(parse_address(args.worker), args.authkey.encode(), cache,
+             args.parallel, args.verbose)
+        if cache:
+            cache.close()
+        parser.exit()
+    if not args.paths and not (args.daemon or args.ask):
+        print_help()
+        parser.exit()
 
-    elif args.aut:
-        for k, v in automorphs(args).items():
-            print("[{}] {}".format(k, v))
-    elif args.iso:
-        for c in equivalence_classes(args):
-            print(c)
+    # Expand globs, keeping paths that match nothing for the error message
+    args.paths = [
+        p for pattern in args.paths
+        for p in sorted(glob.glob(pattern)) or [pattern]
+    ]
+
+    if args.daemon:
+        daemon(args)
+    elif args.ask:
+        ask(args)
+    elif args.serve:
+        serve(args)
+    elif args.json:
+        asyncio.run(stream(args))
+    else:
+        cache = open_cache(args)
+        for path in args.paths:
+            if len(args.paths) > 1:
+                print(path)
+            report(for_file(args, path), cache)
+        if cache:
+            cache.close()
@@ -0,0 +1,176 @@
+"""
+Persistent store of automorphism counts, generating sets and isomorphism
+test results with the isomorphisms found, so repeated graphs only cost a
+lookup.
+
+Graphs are keyed by a fingerprint: the canonical certificate for unlabeled
+trees, which is shared by all isomorphic trees, and a hash of the exact
+adjacency, labels and weights otherwise. Entries that have not been used for the longest time are
+evicted once the store holds more than max_entries of them.
+"""
+import json
+import sqlite3
+from time import time
+from hashlib import sha256
+from weakref import WeakKeyDictionary
+from permv2 import permutation
+from graph_adj import *
+from graph_lib import tree_certificate
+
+DEFAULT_MAX_ENTRIES = 100000
+
+
+def inverse(mapping: "List[int]") -> List[int]:
+    result = [0] * len(mapping)
+    for v, w in enumerate(mapping):
+        result[w] = v
+    return result
+
+
+def fingerprint(G: "Graph") -> str:
+    if G.is_tree() and not G.is_labeled:
+        return "T" + tree_certificate(G)
+
+    h = sha256(str(G.size).encode())
+    for e in G.edges:
+        h.update(b";%d,%d" % (e.head, e.tail))
+        if e.weight is not None:
+            h.update(b":" + repr(e.weight).encode())
+    if G.labels is not None:
+        for label in G.labels:
+            h.update(b"=" + repr(label).encode())
+    return "G" + h.hexdigest()
+
+
+class ResultCache:
+    def __init__(self, path: "str", max_entries: "int" = DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._fingerprints = WeakKeyDictionary()
+        # Several worker processes may share the file
+        self._db = sqlite3.connect(path, timeout=60)
+        self._db.execute("CREATE TABLE IF NOT EXISTS automorphs ("
+                         "key TEXT PRIMARY KEY, count TEXT, generators TEXT, "
+                         "last_used REAL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS isomorphs ("
+                         "key TEXT PRIMARY KEY, result INTEGER, "
+                         "last_used REAL, mapping TEXT)")
+        # Files written before mappings were stored
+        columns = [
+            row[1]
+            for row in self._db.execute("PRAGMA table_info(isomorphs)")
+        ]
+        if "mapping" not in columns:
+            self._db.execute("ALTER TABLE isomorphs ADD COLUMN mapping TEXT")
+        self._db.commit()
+
+    def fingerprint(self, G: "Graph") -> str:
+        if G not in self._fingerprints:
+            self._fingerprints[G] = fingerprint(G)
+        return self._fingerprints[G]
+
+    def pair_key(self, A: "Graph", B: "Graph") -> str:
+        return ":".join(sorted([self.fingerprint(A), self.fingerprint(B)]))
+
+    def _lookup(self, table: "str", columns: "str", key: "str"):
+        row = self._db.execute(
+            "SELECT {} FROM {} WHERE key = ?".format(columns, table),
+            (key, )).fetchone()
+        if row is not None:
+            self._db.execute(
+                "UPDATE {} SET last_used = ? WHERE key = ?".format(table),
+                (time(), key))
+            self._db.commit()
+        return row
+
+    def _store(self, table: "str", row: "dict"):
+        row = dict(row, last_used=time())
+        self._db.execute(
+            "INSERT OR REPLACE INTO {} ({}) VALUES ({})".format(
+                table, ", ".join(row), ", ".join("?" * len(row))),
+            tuple(row.values()))
+        # Evict the least recently used entries
+        self._db.execute(
+            "DELETE FROM {0} WHERE key IN (SELECT key FROM {0} "
+            "ORDER BY last_used LIMIT max(0, (SELECT count(*) FROM {0}) - ?))"
+            .format(table), (self.max_entries, ))
+        self._db.commit()
+
+    def aut_count(self, G: "Graph") -> int:
+        """
+        Returns the stored number of automorphisms of G, or None
+        """
+        row = self._lookup("automorphs", "count", self.fingerprint(G))
+        return None if row is None else int(row[0])
+
+    def generators(self, G: "Graph") -> List[permutation]:
+        """
+        Returns the stored generating set of Aut(G), or None
+        """
+        row = self._lookup("automorphs", "generators", self.fingerprint(G))
+        if row is None or row[0] is None:
+            return None
+        return [permutation(G.size, mapping=P) for P in json.loads(row[0])]
+
+    def store_aut(self, G: "Graph", count: "int", generators: "List" = None):
+        # Generators are only meaningful for the labeling they were found on
+        if generators is not None and not self.fingerprint(G).startswith(
+                "T"):
+            generators = json.dumps([P.P for P in generators])
+        else:
+            generators = None
+        self._store("automorphs", {
+            "key": self.fingerprint(G),
+            "count": str(count),
+            "generators": generators
+        })
+
+    def iso(self, A: "Graph", B: "Graph") -> bool:
+        """
+        Returns the stored isomorphism test result of A and B, or None
+        """
+        a, b = self.fingerprint(A), self.fingerprint(B)
+        # Equal fingerprints mean equal graphs, tree certificates are
+        # canonical
+        if a == b or a.startswith("T") and b.startswith("T"):
+            return a == b
+        row = self._lookup("isomorphs", "result", self.pair_key(A, B))
+        return None if row is None else bool(row[0])
+
+    def mapping(self, A: "Graph", B: "Graph") -> List[int]:
+        """
+        Returns the stored isomorphism of A to B, or None. It is only as
+        trustworthy as the file, see graph_lib.is_isomorphism.
+        """
+        a, b = self.fingerprint(A), self.fingerprint(B)
+        # Equal fingerprints of non trees mean equal adjacency
+        if a == b and not a.startswith("T"):
+            return list(range(A.size))
+        row = self._lookup("isomorphs", "mapping", self.pair_key(A, B))
+        if row is None or row[0] is None:
+            return None
+        mapping = json.loads(row[0])
+        if sorted(mapping) != list(range(A.size)):
+            return None
+        return mapping if a <= b else inverse(mapping)
+
+    def store_iso(self,
+                  A: "Graph",
+                  B: "Graph",
+                  result: "bool",
+                  mapping: "List[int]" = None):
+        """
+        Stores the test result of A and B and, if they are isomorphic, the
+        isomorphism mapping of A to B
+        """
+        # Mappings are stored from the graph with the smaller fingerprint
+        if mapping is not None and self.fingerprint(A) > self.fingerprint(B):
+            mapping = inverse(mapping)
+        self._store(
+            "isomorphs", {
+                "key": self.pair_key(A, B),
+                "result": int(result),
+                "mapping": None if mapping is None else json.dumps(mapping)
+            })
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,244 @@
+"""
+Sharded batch mode: a coordinator groups the graphs of all files into
+shards of graphs with equal invariants, which can only be isomorphic to
+each other, and hands them to worker processes over TCP or Unix sockets.
+Workers may run on other machines and may join at any time. The shard of
+a worker whose connection breaks is handed to the next worker.
+
+Addresses are host:port for TCP and a file path for a Unix socket.
+"""
+import secrets
+import threading
+from queue import Queue
+from time import sleep, monotonic
+from multiprocessing.connection import Listener, Client
+from graph_adj import Graph, Edge
+from graph_io_adj import build_graph
+from graph_lib import is_isomorphism
+from classify import Classifier
+
+
+# Seconds a worker keeps trying to reach a coordinator that is not up yet
+CONNECT_TIMEOUT = 30
+
+
+def new_authkey() -> bytes:
+    """
+    Random shared secret for a listener started without one. Connections
+    unpickle what the peer sends, so there is no default key.
+    """
+    return secrets.token_hex(16).encode()
+
+
+def parse_address(address: "str"):
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit():
+        return host or "localhost", int(port)
+    return address
+
+
+def bucket_key(G: "Graph"):
+    return G.size, G.num_edges, tuple(sorted(G.degrees))
+
+
+def pack(G: "Graph"):
+    """
+    Returns the number of vertices, the edges of G, loops included, with
+    their weight if they have one, and the vertex labels
+    """
+    edges = list()
+    for i, nb in enumerate(G.neighbors):
+        for j in nb:
+            if j <= i:
+                w = G.weight(i, j)
+                edges.append((i, j) if w is None else (i, j, w))
+    return G.size, edges, G.labels
+
+
+def unpack(n: "int", edges: "List[tuple]", labels: "List" = None) -> Graph:
+    labels = list(enumerate(labels)) if labels is not None else []
+    return build_graph(n, [Edge(*e) for e in edges] + labels)
+
+
+def make_shards(graphs: "dict") -> "List[list]":
+    """
+    Groups the keys of graphs, a dict key -> Graph, by invariant bucket
+    """
+    buckets = dict()
+    for key, G in graphs.items():
+        buckets.setdefault(bucket_key(G), list()).append(key)
+    return list(buckets.values())
+
+
+class Coordinator:
+    """
+    Hands the shards of graphs to the workers that connect to address and
+    passes the result of every shard, in terms of the keys of graphs, to
+    on_result(classes, counts, undecided) as soon as it arrives.
+    options are the Classifier options of the workers, authkey the shared
+    secret of the workers, a random one by default. Class members are
+    only accepted with an isomorphism from the first graph of their class
+    that checks out, the others are split off as undecided.
+    """
+
+    def __init__(self,
+                 address,
+                 graphs: "dict",
+                 options: "dict",
+                 iso: "bool" = True,
+                 aut: "bool" = True,
+                 authkey: "bytes" = None):
+        self.address = address
+        self.graphs = graphs
+        self.shards = make_shards(graphs)
+        self.options = options
+        self.iso = iso
+        self.aut = aut
+        self.authkey = new_authkey() if authkey is None else authkey
+
+        self.queue = Queue()
+        self.lock = threading.Lock()
+        self.finished = 0
+        self.done = threading.Event()
+        self.handlers = 0
+
+    def run(self, on_result):
+        if not self.shards:
+            return
+        for shard_id in range(len(self.shards)):
+            self.queue.put(shard_id)
+
+        listener = Listener(self.address, authkey=self.authkey)
+        accepting = threading.Thread(target=self.accept,
+                                     args=(listener, on_result),
+                                     daemon=True)
+        accepting.start()
+        self.done.wait()
+        listener.close()
+        # Release the handlers waiting for a shard
+        for _ in range(self.handlers):
+            self.queue.put(None)
+
+    def accept(self, listener: "Listener", on_result):
+        while not self.done.is_set():
+            try:
+                conn = listener.accept()
+            except OSError:
+                return
+            with self.lock:
+                self.handlers += 1
+            threading.Thread(target=self.serve,
+                             args=(conn, on_result),
+                             daemon=True).start()
+
+    def serve(self, conn, on_result):
+        """
+        Feeds shards to a single worker until all are done or the
+        connection breaks, in which case its shard is queued again
+        """
+        while True:
+            shard_id = self.queue.get()
+            if shard_id is None:
+                try:
+                    conn.send(None)
+                except OSError:
+                    pass
+                conn.close()
+                return
+
+            keys = self.shards[shard_id]
+            try:
+                conn.send({
+                    "graphs": [pack(self.graphs[k]) for k in keys],
+                    "options": self.options,
+                    "iso": self.iso,
+                    "aut": self.aut
+                })
+                result = conn.recv()
+            except (EOFError, OSError):
+                self.queue.put(shard_id)
+                conn.close()
+                return
+
+            classes, undecided = self.verify(keys, result)
+            with self.lock:
+                on_result(classes,
+                          {keys[i]: n
+                           for i, n in result["counts"].items()}, undecided)
+                self.finished += 1
+                if self.finished == len(self.shards):
+                    self.done.set()
+
+
+    def verify(self, keys: "list", result: "dict"):
+        """
+        Returns the classes and undecided pairs of a shard result in terms
+        of the keys of graphs, after checking the isomorphism of every class
+        member
+        """
+        classes = list()
+        undecided = [[keys[i] for i in p] for p in result["undecided"]]
+        for c in result["classes"]:
+            first = keys[c[0]]
+            members = [first]
+            for i in c[1:]:
+                mapping = result["mappings"].get(i)
+                if mapping is not None and is_isomorphism(
+                        self.graphs[first], self.graphs[keys[i]], mapping):
+                    members.append(keys[i])
+                else:
+                    classes.append([keys[i]])
+                    undecided.append([first, keys[i]])
+            classes.append(members)
+        return classes, undecided
+
+
+def work(address,
+         authkey: "bytes",
+         cache: "ResultCache" = None,
+         parallel: "int" = None,
+         verbose: "bool" = False):
+    """
+    Worker loop: classifies the shards sent by the coordinator at address
+    until it says stop or goes away. cache and parallel are local to this
+    worker, the other options come with every shard.
+    """
+    deadline = monotonic() + CONNECT_TIMEOUT
+    while True:
+        try:
+            conn = Client(address, authkey=authkey)
+            break
+        except (FileNotFoundError, ConnectionRefusedError):
+            if monotonic() > deadline:
+                raise
+            sleep(0.5)
+
+    # Subtree codes stay valid across shards
+    codes = None
+    while True:
+        try:
+            shard = conn.recv()
+        except (EOFError, OSError):
+            break
+        if shard is None:
+            break
+
+        graphs = [unpack(*g) for g in shard["graphs"]]
+        classifier = Classifier(**shard["options"],
+                                cache=cache,
+                                codes=codes,
+                                verbose=verbose,
+                                parallel=parallel)
+        codes = classifier.codes
+        if verbose:
+            print("Classifying a shard of {} graphs".format(len(graphs)))
+        result = classifier.classify(graphs,
+                                     iso=shard["iso"],
+                                     aut=shard["aut"])
+        conn.send({
+            "classes": result.classes,
+            "counts": result.counts,
+            "undecided": result.undecided,
+            "mappings": result.mappings
+        })
+    conn.close()
@@ -0,0 +1,35 @@
+from io import StringIO
+import pytest
+from graph_io_adj import load_graph_list, load_graph_file, read_graph_list, read_sparse6, write_graph6, write_sparse6
+from generators import from_edges, hypercube, random_tree
+
+
+@pytest.mark.parametrize("write, header",
+                         [(write_graph6, ">>graph6<<"),
+                          (write_sparse6, ">>sparse6<<")])
+def test_compact_file_with_header(tmp_path, write, header):
+    graphs = [hypercube(3), random_tree(20, seed=1)]
+    path = tmp_path / "graphs.g6"
+    path.write_text("".join(header + write(G) + "\n" for G in graphs))
+
+    loaded = load_graph_file(str(path))
+    assert [[sorted(nb) for nb in G.neighbors] for G in loaded
+            ] == [[sorted(nb) for nb in G.neighbors] for G in graphs]
+
+
+def test_edge_list_ends_at_eof():
+    with pytest.raises(ValueError):
+        read_graph_list(StringIO("# Number of vertices:\n"))
+    assert load_graph_list(StringIO("2\n0,1\n"))[0].num_edges == 1
+
+
+@pytest.mark.parametrize("edges, line", [
+    ([(0, 2), (1, 2)], ":CoJ"),
+    ([(0, 1)], ":Cf"),
+])
+def test_sparse6_padding(edges, line):
+    G = from_edges(4, edges)
+    assert write_sparse6(G) == line
+    H = read_sparse6(line)
+    assert [sorted(nb) for nb in H.neighbors
+            ] == [sorted(nb) for nb in G.neighbors]
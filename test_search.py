@@ -0,0 +1,154 @@
+from itertools import permutations
+from random import Random
+import pytest
+from graph_adj import Edge, Graph
+from graph_lib import Budget, UNDECIDED, is_isomorphism
+from cell_selection import STRATEGIES
+from is_iso import is_iso
+from count_aut import count_aut
+from classify import classify
+from result_cache import ResultCache
+from generators import (cfi_pair, hypercube, random_cycles, random_regular,
+                        random_tree, relabeled, three_paths, torus)
+
+
+def random_graph(n, seed, labels=0, weights=0):
+    rng = Random(seed)
+    G = Graph(n)
+    for u in range(n):
+        for v in range(u + 1, n):
+            if rng.random() < 0.5:
+                weight = rng.randrange(weights) if weights else None
+                G.add_edge(Edge(u, v, weight))
+    if labels:
+        for v in range(n):
+            G.set_label(v, "abc"[rng.randrange(labels)])
+    return G
+
+
+def brute_count(G):
+    return sum(
+        is_isomorphism(G, G, list(p)) for p in permutations(range(G.size)))
+
+
+def brute_iso(A, B):
+    return A.size == B.size and any(
+        is_isomorphism(A, B, list(p)) for p in permutations(range(A.size)))
+
+
+# Small enough for brute force, with and without labels and weights
+GRAPHS = [random_graph(n, seed, labels, weights)
+          for n, seed, labels, weights in [(1, 0, 0, 0), (4, 1, 0, 0),
+                                           (5, 2, 2, 0), (6, 3, 0, 0),
+                                           (6, 4, 0, 2), (7, 5, 0, 0),
+                                           (7, 6, 3, 0)]]
+GRAPHS += [random_tree(n, seed=n) for n in (2, 5, 7)]
+GRAPHS += [torus(3)]
+# Every graph with a relabeled copy and with a random graph of its size
+PAIRS = [(G, relabeled(G, seed=1)) for G in GRAPHS
+         ] + [(G, random_graph(G.size, 7)) for G in GRAPHS]
+COUNTS = [brute_count(G) for G in GRAPHS]
+
+
+@pytest.mark.parametrize("strategy", sorted(STRATEGIES) + ["auto"])
+@pytest.mark.parametrize("wl2_depth", [0, 2])
+def test_iso_against_brute_force(strategy, wl2_depth):
+    for A, B in PAIRS:
+        mapping = list()
+        result = is_iso(A, B, strategy=strategy, wl2_depth=wl2_depth,
+                        mapping=mapping)
+        assert result == brute_iso(A, B)
+        if result:
+            assert is_isomorphism(A, B, mapping)
+
+
+@pytest.mark.parametrize("strategy", sorted(STRATEGIES) + ["auto"])
+@pytest.mark.parametrize("wl2_depth", [0, 2])
+def test_count_against_brute_force(strategy, wl2_depth):
+    for G, count in zip(GRAPHS, COUNTS):
+        generators = list()
+        assert count_aut(G, strategy=strategy, generators=generators,
+                         wl2_depth=wl2_depth) == count
+        for P in generators:
+            assert is_isomorphism(G, G, P.P)
+
+
+def test_parallel_search():
+    for A, B in PAIRS[::3]:
+        mapping = list()
+        result = is_iso(A, B, parallel=2, mapping=mapping)
+        assert result == brute_iso(A, B)
+        if result:
+            assert is_isomorphism(A, B, mapping)
+    for G, count in list(zip(GRAPHS, COUNTS))[::3]:
+        assert count_aut(G, parallel=2) == count
+
+
+def test_budget_gives_undecided_or_correct_results():
+    for A, B in PAIRS:
+        result = is_iso(A, B, budget=Budget(max_nodes=1))
+        assert result is UNDECIDED or result == brute_iso(A, B)
+    for G, count in zip(GRAPHS, COUNTS):
+        result = count_aut(G, budget=Budget(max_nodes=1))
+        assert result is UNDECIDED or result == count
+    # The search on a torus needs more than one node
+    assert count_aut(torus(4), budget=Budget(max_nodes=1)) is UNDECIDED
+
+
+def test_undecided_classification():
+    graphs = [torus(4), relabeled(torus(4), seed=2), hypercube(4)]
+    result = classify(graphs, max_nodes=1)
+    assert result.undecided or len(result.classes) < len(graphs)
+    assert UNDECIDED in result.counts.values()
+
+
+def test_tree_codes_and_mappings():
+    for n in range(1, 8):
+        for seed in range(3):
+            A = random_tree(n, seed=seed)
+            B = relabeled(A, seed=seed)
+            mapping = list()
+            assert is_iso(A, B, mapping=mapping)
+            assert is_isomorphism(A, B, mapping)
+            assert count_aut(A) == brute_count(A)
+            C = random_tree(n, seed=seed + 10)
+            assert is_iso(A, C) == brute_iso(A, C)
+
+
+@pytest.mark.parametrize("strategy", ["iso_first", "aut_first"])
+def test_cache_round_trip(tmp_path, strategy):
+    graphs = GRAPHS + [relabeled(G, seed=3) for G in GRAPHS]
+    path = str(tmp_path / "results.db")
+    first = classify(graphs, strategy, cache=ResultCache(path))
+    second = classify(graphs, strategy, cache=ResultCache(path))
+    assert second.classes == first.classes
+    for i in range(len(graphs)):
+        assert second.counts[i] == first.counts[i] == COUNTS[i % len(GRAPHS)]
+    for i, mapping in second.mappings.items():
+        c = next(c for c in second.classes if i in c)
+        assert is_isomorphism(graphs[c[0]], graphs[i], mapping)
+    for i, generators in second.generators.items():
+        for P in generators:
+            assert is_isomorphism(graphs[i], graphs[i], P.P)
+
+
+def test_generators():
+    assert count_aut(hypercube(3)) == 48
+    assert count_aut(torus(3)) == 72
+    for n, d in [(8, 3), (10, 4)]:
+        G = random_regular(n, d, seed=n)
+        assert G.size == n
+        assert all(len(nb) == d for nb in G.neighbors)
+    assert random_tree(7, seed=0).is_tree()
+    assert three_paths(3).size == 9
+    assert sum(random_cycles(20, seed=0)) == 20
+    plain, twisted = cfi_pair(4, seed=0)
+    assert not is_iso(plain, twisted)
+
+
+@pytest.mark.parametrize("make", [lambda: torus(2), lambda: random_regular(5),
+                                  lambda: three_paths(1),
+                                  lambda: random_cycles(2)])
+def test_generator_errors(make):
+    with pytest.raises(ValueError):
+        make()